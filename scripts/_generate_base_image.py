@@ -1,4 +1,5 @@
 import argparse
+import json
 import os
 import pickle
 
@@ -11,6 +12,11 @@ from shapely.ops import unary_union
 
 DataAccessLayer.changeEDEXHost("edex-cloud.unidata.ucar.edu")
 
+# Size of the pre-rasterized base layers, drawn at a higher resolution than
+# the 12 inch, 100 dpi maps they end up in so downsampling keeps lines sharp
+RASTER_WIDTH = 12
+RASTER_DPI = 200
+
 states = [
     "AL",
     "AK",
@@ -146,6 +152,27 @@ def plot_lakes(ax, envelope=None):
     ax.add_feature(shape_feature, zorder=2, alpha=0.3)
 
 
+def save_raster(output_dir, name, bbox, draw, zorder):
+    # Renders the static layers alone on a transparent background that covers
+    # exactly the saved extent, for src/figures.py to composite under overlays
+    height = RASTER_WIDTH * (bbox[3] - bbox[2]) / (bbox[1] - bbox[0])
+    fig = plt.figure(figsize=(RASTER_WIDTH, height))
+    ax = fig.add_axes([0, 0, 1, 1], projection=ccrs.PlateCarree())
+    ax.set_extent(bbox, crs=ccrs.PlateCarree())
+    # Fill the whole figure and widen the extent instead if the aspect doesn't quite match
+    ax.set_adjustable('datalim')
+    ax.set_axis_off()
+    draw(ax)
+    fig.savefig(os.path.join(output_dir, name + ".png"), dpi=RASTER_DPI, transparent=True)
+    with open(os.path.join(output_dir, name + ".georef.json"), "w") as outfile:
+        json.dump({
+            "bbox": bbox,
+            "extent": list(ax.get_extent(ccrs.PlateCarree())),
+            "zorder": zorder,
+        }, outfile)
+    plt.close(fig)
+
+
 def generate_state(state, output_dir):
     request = DataAccessLayer.newDataRequest('maps')
     request.addIdentifier('table', 'mapdata.county')
@@ -165,27 +192,39 @@ def generate_state(state, output_dir):
     # All WFO counties merged to a single Polygon
     merged_counties = unary_union(counties)
     envelope = merged_counties.buffer(0)
-    # Plot the merged Polygon
-    shape_feature = ShapelyFeature(merged_counties, ccrs.PlateCarree(),
-                                   facecolor='none', linestyle="-", linewidth=1.5, edgecolor='black')
 
     # Get bounds of this merged Polygon to use as buffered map extent
     bounds = merged_counties.bounds
     bbox = [bounds[0]-.25, bounds[2]+.25, bounds[1]-.25, bounds[3]+.25]
 
+    def draw(ax):
+        # Plot the merged Polygon
+        shape_feature = ShapelyFeature(merged_counties, ccrs.PlateCarree(),
+                                       facecolor='none', linestyle="-", linewidth=1.5, edgecolor='black')
+        ax.add_feature(shape_feature, zorder=1)
+        shape_feature = ShapelyFeature(counties, ccrs.PlateCarree(),
+                                       facecolor='none', linestyle="-", edgecolor='#86989B')
+        ax.add_feature(shape_feature, zorder=3)
+        plot_interstates(ax, envelope=envelope)
+        plot_lakes(ax, envelope=envelope)
+        plot_rivers(ax, envelope=envelope)
+
     fig, ax = plt.subplots(figsize=(12, 12), subplot_kw=dict(projection=ccrs.PlateCarree()))
     ax.set_extent(bbox)
     ax.grid(False)
-    ax.add_feature(shape_feature, zorder=1)
-    shape_feature = ShapelyFeature(counties, ccrs.PlateCarree(),
-                                   facecolor='none', linestyle="-", edgecolor='#86989B')
-    ax.add_feature(shape_feature, zorder=3)
-    plot_interstates(ax, envelope=envelope)
-    plot_lakes(ax, envelope=envelope)
-    plot_rivers(ax, envelope=envelope)
+    draw(ax)
 
     with open(os.path.join(output_dir, state + ".pickle"), "wb") as outfile:
         pickle.dump(fig, outfile)
+    # src/map.py reads these instead of fetching and merging every county on each render.
+    # The envelope only filters the radar request, so a simplified outline is enough
+    with open(os.path.join(output_dir, state + ".boundary.json"), "w") as outfile:
+        json.dump({
+            "bbox": bbox,
+            "envelope": envelope.simplify(0.01, preserve_topology=True).wkb_hex,
+        }, outfile)
+    # Counties are drawn at zorder 3, so the raster goes above alert fills and below radar
+    save_raster(output_dir, state, bbox, draw, zorder=3)
 
 
 def plot_country(ax):
@@ -216,10 +255,15 @@ def generate_country(output_dir):
     class Anon:
         envelope = Bounds(bounds)
 
-    plot_interstates(ax, envelope=Anon())
-    plot_country(ax)
+    def draw(ax):
+        plot_interstates(ax, envelope=Anon())
+        plot_country(ax)
+
+    draw(ax)
     with open(os.path.join(output_dir, "US.pickle"), "wb") as outfile:
         pickle.dump(fig, outfile)
+    # SPC outlooks are drawn at zorder 3, above every static layer
+    save_raster(output_dir, "US", bounds, draw, zorder=2)
 
 
 if __name__ == "__main__":
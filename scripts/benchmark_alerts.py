@@ -0,0 +1,55 @@
+import argparse
+import json
+import time
+import tracemalloc
+
+import requests
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Measure WXAlert parse time and memory use')
+    parser.add_argument('--file', type=str, help='Saved alerts GeoJSON, fetches the nationwide feed if not given')
+    parser.add_argument('--polygons', action='store_true', help='Also build each alert polygon')
+    args = parser.parse_args()
+
+    from src.alert import WXAlert
+    from src.config import get_config
+
+    if args.file:
+        with open(args.file, 'r') as f:
+            alertsJSON = json.load(f)
+    else:
+        alertsJSON = requests.get(
+            'https://api.weather.gov/alerts/active?status=actual',
+            headers={
+                'Accept': 'application/geo+json',
+                'User-Agent': get_config().get('nws', 'user_agent')
+            }
+        ).json()
+    features = alertsJSON['features']
+    if len(features) == 0:
+        raise ValueError("No alerts to benchmark")
+
+    tracemalloc.start()
+    start_mem = tracemalloc.get_traced_memory()[0]
+    time_start = time.perf_counter()
+    alerts = [WXAlert(feature, None) for feature in features]
+    parse_time = time.perf_counter() - time_start
+    parse_mem = tracemalloc.get_traced_memory()[0] - start_mem
+    print("Alerts: {}".format(len(alerts)))
+    print("Parse time per alert: {:.1f} us".format(parse_time / len(alerts) * 1e6))
+    print("Memory per alert: {:.0f} bytes".format(parse_mem / len(alerts)))
+
+    if args.polygons:
+        time_start = time.perf_counter()
+        for alert in alerts:
+            alert.polygon
+        polygon_time = time.perf_counter() - time_start
+        polygon_mem = tracemalloc.get_traced_memory()[0] - start_mem
+        print("Polygon time per alert: {:.1f} ms".format(polygon_time / len(alerts) * 1e3))
+        print("Memory per alert with polygon: {:.0f} bytes".format(polygon_mem / len(alerts)))
+    tracemalloc.stop()
+
+
+if __name__ == "__main__":
+    main()
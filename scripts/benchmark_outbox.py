@@ -0,0 +1,78 @@
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+import os
+import tempfile
+import time
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Measure delivery outbox throughput during a burst of alerts')
+    parser.add_argument('--alerts', type=int, default=500, help='Alerts in the burst')
+    parser.add_argument('--channels', type=int, default=200, help='Channels every alert is delivered to')
+    parser.add_argument('--teams', type=int, default=50, help='Workspaces the channels are spread over')
+    parser.add_argument('--workers', type=int, default=8, help='Threads completing deliveries, like slack.delivery_workers')
+    parser.add_argument('--failures', type=float, default=0.05, help='Fraction of deliveries that fail and are retried')
+    args = parser.parse_args()
+
+    from src.outbox import Outbox
+
+    with tempfile.TemporaryDirectory() as directory:
+        outbox = Outbox(os.path.join(directory, 'outbox.sqlite3'), max_attempts=5, retry_interval=0, claim_timeout=300)
+        features = [
+            {'properties': {'id': f'urn:oid:benchmark.{i}'}, 'geometry': None}
+            for i in range(args.alerts)
+        ]
+        targets = [(f'T{i % args.teams}', f'C{i}') for i in range(args.channels)]
+        deliveries = args.alerts * args.channels
+        print("Alerts: {}, deliveries: {}".format(args.alerts, deliveries))
+
+        time_start = time.perf_counter()
+        outbox.add_alerts('OK', features)
+        record_time = time.perf_counter() - time_start
+        print("Record alerts: {:.0f} alerts/s".format(args.alerts / record_time))
+
+        time_start = time.perf_counter()
+        for feature in features:
+            outbox.add_deliveries(feature['properties']['id'], 'OK', targets)
+        expand_time = time.perf_counter() - time_start
+        print("Expand into deliveries: {:.0f} deliveries/s".format(deliveries / expand_time))
+
+        def deliver(rows):
+            for i, row in enumerate(rows):
+                if args.failures and i % int(1 / args.failures) == 0:
+                    outbox.retry(row[0], 'benchmark failure')
+                else:
+                    outbox.complete(row[0])
+
+        time_start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=args.workers) as executor:
+            futures = [
+                executor.submit(lambda alert_id: deliver(outbox.claim_deliveries(alert_id, 'OK')), feature['properties']['id'])
+                for feature in features
+            ]
+            for future in futures:
+                future.result()
+        drain_time = time.perf_counter() - time_start
+        print("Claim and complete: {:.0f} deliveries/s with {} workers".format(deliveries / drain_time, args.workers))
+
+        time_start = time.perf_counter()
+        retried = 0
+        while True:
+            rows = outbox.claim_due_deliveries()
+            if not rows:
+                break
+            for row in rows:
+                outbox.complete(row[0])
+            retried += len(rows)
+        replay_time = time.perf_counter() - time_start
+        if retried:
+            print("Replay retries: {} deliveries at {:.0f} deliveries/s".format(retried, retried / replay_time))
+
+        time_start = time.perf_counter()
+        outbox.purge(-1)
+        print("Purge: {:.2f} s".format(time.perf_counter() - time_start))
+        outbox.close()
+
+
+if __name__ == "__main__":
+    main()
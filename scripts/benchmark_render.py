@@ -0,0 +1,52 @@
+import argparse
+import time
+
+import numpy as np
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Measure cold and warm base map render times')
+    parser.add_argument('states', type=str, nargs='*', default=['OK', 'TX', 'US'], help='Base maps in .states to render')
+    parser.add_argument('--renders', type=int, default=5, help='Warm renders per base map')
+    args = parser.parse_args()
+
+    from src.figures import FigureTemplateCache, figure_to_png
+
+    cache = FigureTemplateCache(len(args.states))
+
+    def render(state):
+        with cache.figure(state) as fig:
+            ax = fig.axes[0]
+            # Stand-in for an alert polygon, in the map's own coordinates
+            (x0, x1), (y0, y1) = ax.get_xlim(), ax.get_ylim()
+            ax.plot([x0 + (x1 - x0) / 4, x1 - (x1 - x0) / 4], [y0 + (y1 - y0) / 4, y1 - (y1 - y0) / 4],
+                    color='red', linewidth=3, zorder=6)
+            # Stand-in for radar, which also adds a colorbar like plot_radar does
+            xs, ys = np.meshgrid(np.linspace(x0, x1, 50), np.linspace(y0, y1, 50))
+            cs = ax.pcolormesh(xs, ys, np.hypot(xs - xs.mean(), ys - ys.mean()), zorder=4, alpha=0.7)
+            cbar = fig.colorbar(cs, extend='both', shrink=0.5, orientation='horizontal')
+            cbar.set_label("Benchmark")
+            ax.set_title(f"Benchmark {state}", fontsize=32)
+            return figure_to_png(fig)
+
+    for state in args.states:
+        time_start = time.perf_counter()
+        cold_image = render(state)
+        cold_time = time.perf_counter() - time_start
+
+        warm_times = []
+        for _ in range(args.renders):
+            time_start = time.perf_counter()
+            warm_image = render(state)
+            warm_times.append(time.perf_counter() - time_start)
+        print("{}: cold {:.2f} s, warm {:.2f} s (best {:.2f} s), {} KB".format(
+            state, cold_time, sum(warm_times) / len(warm_times), min(warm_times), len(warm_image) // 1024))
+        if warm_image != cold_image:
+            # The template has to look the same after every render, anything left
+            # behind or a map that shrinks with each colorbar shows up here
+            print("{}: warm image differs from the cold image ({} bytes, cold {} bytes)".format(
+                state, len(warm_image), len(cold_image)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,107 @@
+import argparse
+from collections import Counter
+from threading import Lock, Thread
+import sys
+import time
+
+
+def wait_for(condition, timeout):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if condition():
+            return True
+        time.sleep(0.5)
+    return condition()
+
+
+class Node():
+    # A LeaseManager that records what it was given instead of starting watchers
+    def __init__(self, name):
+        from src.leases import LeaseManager
+
+        self.name = name
+        self.held = set()
+        self.acquired = Counter()
+        self._lock = Lock()
+        self.manager = LeaseManager(self._on_acquire, self._on_release)
+
+    def _on_acquire(self, state):
+        with self._lock:
+            self.held.add(state)
+            self.acquired[state] += 1
+
+    def _on_release(self, state):
+        with self._lock:
+            self.held.discard(state)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Check the watcher leases against a local DynamoDB stand-in such as DynamoDB Local')
+    parser.add_argument('--states', type=int, default=4, help='Subscribed states to split between two nodes')
+    args = parser.parse_args()
+
+    from src.config import get_config
+    from src.orm import Installation, WatcherLease
+
+    if not get_config().get('dynamodb', 'host'):
+        # Installations are written and deleted, so never run this against a real table
+        print("Set dynamodb.host to a local DynamoDB stand-in, e.g. http://localhost:8000")
+        sys.exit(1)
+    for model in [Installation, WatcherLease]:
+        if not model.exists():
+            model.create_table(billing_mode='PAY_PER_REQUEST', wait=True)
+
+    ttl = get_config().get('leases', 'ttl')
+    states = [f"Z{i}" for i in range(args.states)]
+    for i, state in enumerate(states):
+        Installation(f"TLEASECHECK{i}", bot_token='xoxb-check', bot_started=True, state=state).save()
+
+    failures = []
+
+    def check(name, ok):
+        print("{}: {}".format(name, "ok" if ok else "FAILED"))
+        if not ok:
+            failures.append(name)
+
+    first = Node('first')
+    second = Node('second')
+    try:
+        first.manager.start()
+        check("First node takes every state", wait_for(lambda: first.held == set(states), ttl))
+        lease = WatcherLease.get(states[0])
+        check("Lease is owned by the first node with a cleanup time",
+              lease.owner == first.manager.node_id and lease.cleanup_at is not None)
+
+        # A subscription on the control socket racing the heartbeat must only start one watcher
+        threads = [Thread(target=first.manager.add_state, args=('ZLOCAL',)) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        check("Local state is acquired once", wait_for(lambda: 'ZLOCAL' in first.held, ttl)
+              and first.acquired['ZLOCAL'] == 1)
+
+        second.manager.start()
+        half = len(states) // 2
+        check("States are split between two nodes", wait_for(
+            lambda: len(first.held & set(states)) == len(states) - half and len(second.held) == half, ttl * 3))
+        check("No state is held twice", not (first.held & second.held))
+        check("Local state stays with the first node while it rebalances", 'ZLOCAL' in first.held)
+
+        first.manager.stop()
+        check("Second node takes over every state", wait_for(lambda: second.held == set(states), ttl * 2))
+    finally:
+        first.manager.stop()
+        second.manager.stop()
+        for i in range(len(states)):
+            Installation(f"TLEASECHECK{i}").delete()
+
+    if failures:
+        print("{} checks failed".format(len(failures)))
+        sys.exit(1)
+    print("All checks passed")
+
+
+if __name__ == "__main__":
+    main()
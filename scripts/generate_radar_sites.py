@@ -0,0 +1,48 @@
+import argparse
+import json
+import os
+
+import requests
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Generate the NEXRAD and TDWR site table')
+    parser.add_argument("--output", type=str, help="Output directory")
+    parser.add_argument("--user-agent", type=str, default="nws-slack-bot", help="User-Agent sent to api.weather.gov")
+    args = parser.parse_args()
+
+    if not args.output:
+        raise ValueError("Output directory not specified")
+    if not os.path.exists(args.output):
+        os.mkdir(args.output)
+    elif not os.path.isdir(args.output):
+        raise ValueError("Output is not a directory")
+
+    response = requests.get(
+        'https://api.weather.gov/radar/stations',
+        headers={
+            'Accept': 'application/geo+json',
+            'User-Agent': args.user_agent,
+        },
+    )
+    response.raise_for_status()
+
+    sites = []
+    for feature in response.json()['features']:
+        properties = feature['properties']
+        lon, lat = feature['geometry']['coordinates'][:2]
+        sites.append({
+            "id": properties['id'],
+            "type": properties['stationType'],
+            "lat": lat,
+            "lon": lon,
+        })
+    sites.sort(key=lambda site: site['id'])
+    print("Found {} radar sites".format(len(sites)))
+
+    with open(os.path.join(args.output, "radar_sites.json"), "w") as outfile:
+        json.dump(sites, outfile)
+
+
+if __name__ == "__main__":
+    main()
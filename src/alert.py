@@ -2,17 +2,49 @@ import json
 import sys
 import traceback
 
+from .channels import get_channel_directory
+from .clients import get_client
 from .config import get_config
+from .delivery import get_delivery_queue, wait_for_deliveries
+from .events import get_event_policy
+from .images import store_image
 from .map import plot_alert_on_state
-from .orm import Installation
+from .metrics import increment
+from .outbox import DONE, PENDING, POSTED, get_outbox
+from .subscribers import get_subscriber_directory
+from .zones import get_zone_cache
 
-import requests
 from shapely.geometry import shape, Polygon, MultiPolygon, GeometryCollection
-from slack_sdk import WebClient
 from slack_sdk.errors import SlackApiError
 
 
 class WXAlert():
+    __slots__ = (
+        '_polygon',
+        '_geometry',
+        '_affected_zones',
+        '_policy',
+        'id',
+        'sent',
+        'expires',
+        'effective',
+        'onset',
+        'ends',
+        'message_type',
+        'references',
+        'severity',
+        'certainty',
+        'urgency',
+        'event',
+        'headline',
+        'description',
+        'instruction',
+        'area_desc',
+        'max_hail_size',
+        'max_wind_speed',
+        'state',
+    )
+
     def plot(self, ax):
         if type(self.polygon) == Polygon:
             ax.plot(*self.polygon.exterior.xy, color=self._get_color(), linewidth=3, zorder=6)
@@ -21,286 +53,66 @@ class WXAlert():
                 xs, ys = geom.exterior.xy
                 ax.fill(xs, ys, color=self._get_color(), linewidth=0.5, zorder=1)
 
-    # Event codes: https://www.weather.gov/nwr/eventcodes
-    # https://www.weather.gov/help-map
     def _get_color(self):
-        if self.event == "Blizzard Warning":
-            return "#FF4500"
-        elif self.event == "Coastal Flood Watch":
-            return "#66CDAA"
-        elif self.event == "Coastal Flood Warning":
-            return "#228B22"
-        elif self.event == "Dust Storm Warning":
-            return "#FFE4C4"
-        elif self.event == "Extreme Wind Warning":
-            return "#FF8C00"
-        elif self.event == "Flash Flood Watch":
-            return "#2E8B57"
-        elif self.event == "Flash Flood Warning":
-            return "#8B0000"
-        elif self.event == "Flash Flood Statement":
-            return "#8B0000"
-        elif self.event == "Flood Watch":
-            return "#2E8B57"
-        elif self.event == "Flood Warning":
-            return "#00FF00"
-        elif self.event == "Flood Statement":
-            return "#00FF00"
-        elif self.event == "High Wind Watch":
-            return "#B8860B"
-        elif self.event == "High Wind Warning":
-            return "#DAA520"
-        elif self.event == "Hurricane Watch":
-            return "#FF00FF"
-        elif self.event == "Hurricane Warning":
-            return "#DC143Cs"
-        elif self.event == "Hurricane Statement":
-            return "#FFE4B5"
-        elif self.event == "Severe Thunderstorm Watch":
-            return "#DB7093"
-        elif self.event == "Severe Thunderstorm Warning":
-            return "#FFA500"
-        elif self.event == "Severe Weather Statement":
-            return "#00FFFF"
-        elif self.event == "Snow Squall Warning":
-            return "#C71585"
-        elif self.event == "Special Marine Warning":
-            return "#FFA500"
-        elif self.event == "Special Weather Statement":
-            return "#FFE4B5"
-        elif self.event == "Storm Surge Watch":
-            return "#DB7FF7"
-        elif self.event == "Storm Surge Warning":
-            return "#B524F7"
-        elif self.event == "Tornado Watch":
-            return "#FFFF00"
-        elif self.event == "Tornado Warning":
-            return "#FF0000"
-        elif self.event == "Tropical Storm Watch":
-            return "#F08080"
-        elif self.event == "Tropical Storm Warning":
-            return "#B22222"
-        elif self.event == "Tsunami Watch":
-            return "#FF00FF"
-        elif self.event == "Tsunami Warning":
-            return "#FD6347"
-        elif self.event == "Winter Storm Watch":
-            return "#4682B4"
-        elif self.event == "Winter Storm Warning":
-            return "#FF69B4"
-        elif self.event == "Avalanche Watch":
-            return "#F4A460"
-        elif self.event == "Avalanche Warning":
-            return "#1E90FF"
-        elif self.event == "Blue Alert":
-            return "#B0C4DE"
-        elif self.event == "Child Abduction Emergency":
-            return "#800000"
-        elif self.event == "Civil Danger Warning":
-            return "#FFB6C1"
-        elif self.event == "Civil Emergency Message":
-            return "#FFB6C1"
-        elif self.event == "Earthquake Warning":
-            return "#8B4513"
-        elif self.event == "Evacuation Immediate":
-            return "#7FFF00"
-        elif self.event == "Fire Warning":
-            return "#A0522D"
-        elif self.event == "Hazardous Materials Warning":
-            return "#4B0082"
-        elif self.event == "Law Enforcement Warning":
-            return "#C0C0C0"
-        elif self.event == "Local Area Emergency":
-            return "#C0C0C0"
-        elif self.event == "911 Telephone Outage Emergency":
-            return "#C0C0C0"
-        elif self.event == "Nuclear Power Plant Warning":
-            return "#4B0082"
-        elif self.event == "Radiological Hazard Warning":
-            return "#4B0082"
-        elif self.event == "Shelter in Place Warning":
-            return "#FA8072"
-        elif self.event == "Volcano Warning":
-            return "#2F4F4F"
-        else:
-            return "#FD6347"
+        return self._policy.color
 
     def should_show_radar(self):
-        isWx = self.is_weather()
-        if isWx and self.event == "Blizzard Warning":
-            return True
-        elif isWx and self.event == "Coastal Flood Watch":
-            return False
-        elif isWx and self.event == "Coastal Flood Warning":
-            return True
-        elif isWx and self.event == "Dust Storm Warning":
-            return True
-        elif isWx and self.event == "Extreme Wind Warning":
-            return False
-        elif isWx and self.event == "Flash Flood Watch":
-            return False
-        elif isWx and self.event == "Flash Flood Warning":
-            return True
-        elif isWx and self.event == "Flash Flood Statement":
-            return True
-        elif isWx and self.event == "Flood Advisory":
-            return True
-        elif isWx and self.event == "Flood Watch":
-            return False
-        elif isWx and self.event == "Flood Warning":
-            return True
-        elif isWx and self.event == "Flood Statement":
-            return True
-        elif isWx and self.event == "High Wind Watch":
-            return False
-        elif isWx and self.event == "High Wind Warning":
-            return False
-        elif isWx and self.event == "Hurricane Watch":
-            return False
-        elif isWx and self.event == "Hurricane Warning":
-            return True
-        elif isWx and self.event == "Hurricane Statement":
-            return True
-        elif isWx and self.event == "Severe Thunderstorm Watch":
-            return False
-        elif isWx and self.event == "Severe Thunderstorm Warning":
-            return True
-        elif isWx and self.event == "Severe Weather Statement":
-            return True
-        elif isWx and self.event == "Snow Squall Warning":
-            return True
-        elif isWx and self.event == "Special Marine Warning":
-            return True
-        elif isWx and self.event == "Special Weather Statement":
-            return True
-        elif isWx and self.event == "Storm Surge Watch":
-            return False
-        elif isWx and self.event == "Storm Surge Warning":
-            return True
-        elif isWx and self.event == "Tornado Watch":
-            return False
-        elif isWx and self.event == "Tornado Warning":
-            return True
-        elif isWx and self.event == "Tropical Storm Watch":
-            return False
-        elif isWx and self.event == "Tropical Storm Warning":
-            return True
-        elif isWx and self.event == "Tsunami Watch":
-            return False
-        elif isWx and self.event == "Tsunami Warning":
-            return False
-        elif isWx and self.event == "Winter Storm Watch":
-            return False
-        elif isWx and self.event == "Winter Storm Warning":
-            return True
-        else:
-            return False
+        return self._policy.radar
 
     def is_weather(self):
-        if self.event == "Blizzard Warning":
-            return True
-        elif self.event == "Coastal Flood Watch":
-            return True
-        elif self.event == "Coastal Flood Warning":
-            return True
-        elif self.event == "Dust Storm Warning":
-            return True
-        elif self.event == "Extreme Wind Warning":
-            return True
-        elif self.event == "Flash Flood Watch":
-            return True
-        elif self.event == "Flash Flood Warning":
-            return True
-        elif self.event == "Flash Flood Statement":
-            return True
-        elif self.event == "Flood Advisory":
-            return True
-        elif self.event == "Flood Watch":
-            return True
-        elif self.event == "Flood Warning":
-            return True
-        elif self.event == "Flood Statement":
-            return True
-        elif self.event == "High Wind Watch":
-            return True
-        elif self.event == "High Wind Warning":
-            return True
-        elif self.event == "Hurricane Watch":
-            return True
-        elif self.event == "Hurricane Warning":
-            return True
-        elif self.event == "Hurricane Statement":
-            return True
-        elif self.event == "Severe Thunderstorm Watch":
-            return True
-        elif self.event == "Severe Thunderstorm Warning":
-            return True
-        elif self.event == "Severe Weather Statement":
-            return True
-        elif self.event == "Snow Squall Warning":
-            return True
-        elif self.event == "Special Marine Warning":
-            return True
-        elif self.event == "Special Weather Statement":
-            return True
-        elif self.event == "Storm Surge Watch":
-            return True
-        elif self.event == "Storm Surge Warning":
-            return True
-        elif self.event == "Tornado Watch":
-            return True
-        elif self.event == "Tornado Warning":
-            return True
-        elif self.event == "Tropical Storm Watch":
-            return True
-        elif self.event == "Tropical Storm Warning":
-            return True
-        elif self.event == "Tsunami Watch":
-            return True
-        elif self.event == "Tsunami Warning":
-            return True
-        elif self.event == "Winter Storm Watch":
-            return True
-        elif self.event == "Winter Storm Warning":
-            return True
-        else:
-            return False
+        return self._policy.category == "weather"
+
+    def priority(self):
+        return self._policy.priority
 
     def __init__(self, feature_json, state):
-        self._feature_json = feature_json
         if 'type' not in feature_json or feature_json['type'] != 'Feature':
             raise ValueError('Invalid GeoJSON Feature')
-        self.id = feature_json['properties']['id']
-        if 'geometry' in feature_json and feature_json['geometry'] is not None:
-            self.polygon = shape(feature_json['geometry'])
-        else:
-            self.polygon = self._make_multipolygon(feature_json['properties']['affectedZones'])
-        self.sent = feature_json['properties']['sent']
-        self.expires = feature_json['properties']['expires']
-        self.effective = feature_json['properties']['effective']
-        self.onset = feature_json['properties']['onset']
-        self.ends = feature_json['properties']['ends']
-        self.message_type = feature_json['properties']['messageType']
-        self.severity = feature_json['properties']['severity']
-        self.certainty = feature_json['properties']['certainty']
-        self.urgency = feature_json['properties']['urgency']
-        self.event = feature_json['properties']['event']
-        self.headline = feature_json['properties']['headline']
-        self.description = feature_json['properties']['description']
-        self.instruction = feature_json['properties']['instruction']
+        properties = feature_json['properties']
+        self.id = properties['id']
+        # The polygon is only built when something draws or tests against it, since
+        # zone-based alerts can need a lot of zone geometries to be fetched and merged
+        self._polygon = None
+        self._geometry = feature_json.get('geometry')
+        self._affected_zones = properties['affectedZones'] if self._geometry is None else None
+        self.sent = properties['sent']
+        self.expires = properties['expires']
+        self.effective = properties['effective']
+        self.onset = properties['onset']
+        self.ends = properties['ends']
+        self.message_type = properties['messageType']
+        # IDs of the earlier alerts an Update or Cancel replaces
+        self.references = [reference['identifier'] for reference in properties.get('references', [])]
+        self.severity = properties['severity']
+        self.certainty = properties['certainty']
+        self.urgency = properties['urgency']
+        self.event = properties['event']
+        self._policy = get_event_policy(self.event)
+        self.headline = properties['headline']
+        self.description = properties['description']
+        self.instruction = properties['instruction']
         if self.instruction is None:
             self.instruction = ""
-        self.area_desc = feature_json['properties']['areaDesc']
-        if 'maxHailSize' in feature_json['properties']['parameters']:
-            self.max_hail_size = feature_json['properties']['parameters']['maxHailSize']
-        if 'maxWindSpeed' in feature_json['properties']['parameters']:
-            self.max_wind_speed = feature_json['properties']['parameters']['maxWindSpeed']
+        self.area_desc = properties['areaDesc']
+        self.max_hail_size = properties['parameters'].get('maxHailSize')
+        self.max_wind_speed = properties['parameters'].get('maxWindSpeed')
         self.state = state
 
+    @property
+    def polygon(self):
+        if self._polygon is None:
+            if self._geometry is not None:
+                self._polygon = shape(self._geometry)
+            else:
+                self._polygon = self._make_multipolygon(self._affected_zones)
+            # The raw GeoJSON isn't needed anymore once the polygon exists
+            self._geometry = None
+            self._affected_zones = None
+        return self._polygon
+
     def _make_multipolygon(self, affected_zones):
         ugcs_polygons = []
-        for zone in affected_zones:
-            poly = self._get_polygon_from_url(zone)
+        for poly in get_zone_cache().get_many(affected_zones):
             if type(poly) == Polygon:
                 ugcs_polygons.append(poly)
             elif type(poly) == MultiPolygon:
@@ -318,26 +130,6 @@ class WXAlert():
                         raise ValueError('Invalid polygon')
         return MultiPolygon([poly for poly in ugcs_polygons])
 
-    def _get_polygon_from_url(self, url):
-        response = requests.get(
-            url,
-            headers={
-                'Accept': 'application/geo+json',
-                'User-Agent': get_config().get('nws', 'user_agent')
-            }
-        )
-        if response.status_code != 200:
-            raise ValueError('Failed to get polygon')
-        res = response.json()
-        if 'geometry' not in res or res['geometry'] is None:
-            raise ValueError('Invalid polygon')
-        if ('coordinates' not in res['geometry'] and (res['geometry']['type'] != "Polygon" or res['geometry']['type'] != "MultiPolygon")) \
-                and (res['geometry']['type'] != "GeometryCollection"):
-            print(res)
-            print(url)
-            raise ValueError('Invalid polygon')
-        return shape(res['geometry'])
-
     def __str__(self):
         return f"{self.headline}\n\n" + \
                 f"{self.event}\n\n" + \
@@ -345,8 +137,8 @@ class WXAlert():
                 f"{self.description}\n\n" + \
                 f"{self.instruction}\n\n" + \
                 "\n" + \
-                ("" if not hasattr(self, 'max_hail_size') else f"Max Hail Size: {self.max_hail_size}\n") + \
-                ("" if not hasattr(self, 'max_wind_speed') else f"Max Wind Speed: {self.max_wind_speed}\n") + \
+                ("" if self.max_hail_size is None else f"Max Hail Size: {self.max_hail_size}\n") + \
+                ("" if self.max_wind_speed is None else f"Max Wind Speed: {self.max_wind_speed}\n") + \
                 f"Severity: {self.severity}\n" + \
                 f"Certainty: {self.certainty}\n" + \
                 f"Urgency: {self.urgency}\n" + \
@@ -357,14 +149,17 @@ class WXAlert():
                 f"Onset: {self.onset}\n" + \
                 f"Ends: {self.ends}\n"
 
-    def slack_block(self):
+    def slack_block(self, image_url=None):
         instr = ('\n\n' + self.instruction) if self.instruction else ''
-        return json.dumps([
+        title = f"*{self.headline}*"
+        if self.message_type == 'Cancel':
+            title = f"*Cancelled*: {self.headline or self.event}"
+        blocks = [
                 {
                     "type": "section",
                     "text": {
                         "type": "mrkdwn",
-                        "text": f"*{self.headline}*",
+                        "text": title,
                     },
                 },
                 {
@@ -453,31 +248,221 @@ class WXAlert():
                         },
                     ],
                 },
-            ])
+            ]
+        if image_url:
+            blocks.append({
+                "type": "image",
+                "image_url": image_url,
+                "alt_text": self.headline or self.event,
+            })
+        return json.dumps(blocks)
+
+
+def _record_error(outbox, key, e):
+    print(f"Error posting message: {e}")
+    traceback.print_exception(*sys.exc_info())
+    outbox.retry(key, e)
+
+
+def _edit_alert(team_id, client, alert, key, channel_id, ts, state_image, image_url, shared):
+    # Updates and cancels edit the message of the alert they replace. An update's
+    # new map goes into that message's thread unless it's linked from S3, or is
+    # left POSTED for the caller to share with the workspace's other channels.
+    # Returns the delivery's status afterwards, or None if the original message
+    # is gone and the alert has to be posted instead
+    queue = get_delivery_queue()
+    try:
+        queue.call(
+            team_id, client, 'chat_update',
+            channel=channel_id,
+            ts=ts,
+            blocks=alert.slack_block(image_url=image_url if alert.message_type != 'Cancel' else None),
+            text=str(alert),
+        )
+        if alert.message_type != 'Cancel' and not image_url and shared:
+            get_outbox().mark_posted(key, ts)
+            return POSTED
+        if alert.message_type != 'Cancel' and not image_url:
+            queue.call(
+                team_id, client, 'files_upload_v2',
+                channel=channel_id,
+                thread_ts=ts,
+                content=state_image,
+                title=f"{alert.headline}",
+                filename=f"{alert.event}-{alert.sent}.png",
+            )
+    except SlackApiError as e:
+        if e.response.get('error') in ['message_not_found', 'cant_update_message', 'edit_window_closed']:
+            return None
+        _record_error(get_outbox(), key, e)
+        return PENDING
+    except Exception as e:
+        _record_error(get_outbox(), key, e)
+        return PENDING
+    # chat.update is idempotent, so a failed edit is simply retried from the start
+    get_outbox().complete(key, ts)
+    return DONE
+
+
+def _deliver_alert(team_id, client, alert, rows, state_image, image_url):
+    # Posts the alert to each claimed channel, then sends the map to the channels
+    # it reached. Every step is recorded in the outbox so a retry picks up where
+    # this one stopped instead of posting the message again
+    queue = get_delivery_queue()
+    outbox = get_outbox()
+    shared = get_config().get('slack', 'upload_mode') == 'shared'
+    posted = []
+    for key, channel_id, status, ts in rows:
+        outbox.extend_claims([key])
+        if status == PENDING and ts is not None:
+            edited = _edit_alert(team_id, client, alert, key, channel_id, ts, state_image, image_url, shared)
+            if edited == POSTED:
+                posted.append((key, channel_id))
+            if edited is not None:
+                continue
+        if status == PENDING:
+            try:
+                response = queue.call(
+                    team_id, client, 'chat_postMessage',
+                    channel=channel_id,
+                    blocks=alert.slack_block(image_url=image_url),
+                    text=str(alert),
+                )
+            except Exception as e:
+                _record_error(outbox, key, e)
+                continue
+            if image_url or state_image is None:
+                # The map is already in S3 and linked from the message, or this is a
+                # Cancel whose original message was gone and no map was rendered for it
+                outbox.complete(key, response['ts'])
+                continue
+            outbox.mark_posted(key, response['ts'])
+        posted.append((key, channel_id))
+    if not posted:
+        return
+    if shared:
+        # One upload shared with every channel in the workspace. Slack can only share
+        # a file into one thread, so the maps of edited updates go to the channel too
+        outbox.extend_claims([key for key, _ in posted])
+        try:
+            queue.call(
+                team_id, client, 'upload_and_share',
+                content=state_image,
+                title=f"{alert.headline}",
+                filename=f"{alert.event}-{alert.sent}.png",
+                channel_ids=[channel_id for _, channel_id in posted],
+            )
+        except Exception as e:
+            for key, _ in posted:
+                _record_error(outbox, key, e)
+            return
+        for key, _ in posted:
+            outbox.complete(key)
+        return
+    for key, channel_id in posted:
+        outbox.extend_claims([key])
+        try:
+            queue.call(
+                team_id, client, 'files_upload_v2',
+                channel=channel_id,
+                content=state_image,
+                title=f"{alert.headline}",
+                filename=f"{alert.event}-{alert.sent}.png",
+            )
+        except Exception as e:
+            _record_error(outbox, key, e)
+            continue
+        outbox.complete(key)
+
+
+def _deliver_claimed(alert, rows):
+    # rows are claimed outbox deliveries of this alert
+    state_image = None
+    image_url = None
+    try:
+        # Cancels that only edit earlier messages don't show a map
+        if alert.message_type != 'Cancel' or any(row[6] is None for row in rows):
+            state_image = plot_alert_on_state(alert)
+            if get_config().get('slack', 'image_delivery') == 's3':
+                image_url = store_image(state_image)
+    except Exception as e:
+        for row in rows:
+            _record_error(get_outbox(), row[0], e)
+        return
+    # Shared uploads need a workspace's channels together, otherwise every channel is its own job
+    per_workspace = get_config().get('slack', 'upload_mode') == 'shared' and not image_url
+    jobs = {}
+    for key, _, _, team_id, channel_id, status, ts in rows:
+        job = (team_id,) if per_workspace else (team_id, channel_id)
+        jobs.setdefault(job, []).append((key, channel_id, status, ts))
+    deliveries = []
+    for job, job_rows in jobs.items():
+        installation = get_subscriber_directory().get(job[0])
+        if installation is None:
+            print(f"Installation {job[0]} not found, dropping its deliveries")
+            for key, _, _, _ in job_rows:
+                get_outbox().complete(key)
+            continue
+        client = get_client(installation.team_id, installation.bot_token)
+        deliveries.append(get_delivery_queue().submit(
+            _deliver_alert, installation.team_id, client, alert, job_rows, state_image, image_url))
+    wait_for_deliveries(deliveries)
 
 
 def send_alert(alert):
     # This method will check all chats it is in and send the alert to them
     try:
-        state_image = plot_alert_on_state(alert)
-        for installation in Installation.state_index.query(alert.state):
-            client = WebClient(token=installation.bot_token)
-            for channel in client.conversations_list()['channels']:
-                if channel['is_member'] and not channel['is_archived'] and not channel['is_im']:
-                    client.chat_postMessage(
-                        channel=channel['id'],
-                        blocks=alert.slack_block(),
-                        text=str(alert),
-                    )
-                    client.files_upload_v2(
-                        channel=channel['id'],
-                        content=state_image,
-                        title=f"{alert.headline}",
-                        filename=f"{alert.event}-{alert.sent}.png",
-                    )
+        targets = []
+        for installation in get_subscriber_directory().get_state(alert.state):
+            client = get_client(installation.team_id, installation.bot_token)
+            try:
+                channels = get_channel_directory().get_channels(installation.team_id, client)
+            except Exception as e:
+                # e.g. a workspace that uninstalled the app, which mustn't hold up the others
+                print(f"Skipping {installation.team_id}, failed to list its channels: {e}")
+                traceback.print_exception(*sys.exc_info())
+                increment('channel_list_failed')
+                continue
+            for channel_id in channels:
+                targets.append((installation.team_id, channel_id))
+        outbox = get_outbox()
+        outbox.add_deliveries(alert.id, alert.state, targets, alert.references)
+        rows = outbox.claim_deliveries(alert.id, alert.state)
+        if rows:
+            _deliver_claimed(alert, rows)
     except SlackApiError as e:
         print(f"Error posting message: {e}")
         traceback.print_exception(*sys.exc_info())
     except Exception as e:
         print(e)
         traceback.print_exception(*sys.exc_info())
+
+
+def replay_outbox():
+    # Sends alerts that were recorded but never expanded, then every delivery
+    # that is due for a retry or was left claimed by a crashed process
+    outbox = get_outbox()
+    for alert_id, state, feature in outbox.claim_alerts():
+        print(f"Replaying alert: {alert_id}")
+        try:
+            alert = WXAlert(feature, state)
+        except Exception as e:
+            print(f"Discarding alert {alert_id} that can't be parsed: {e}")
+            traceback.print_exception(*sys.exc_info())
+            outbox.discard_alert(alert_id, state)
+            continue
+        send_alert(alert)
+    rows_by_alert = {}
+    for row in outbox.claim_due_deliveries():
+        rows_by_alert.setdefault((row[1], row[2]), []).append(row)
+    for (alert_id, state), rows in rows_by_alert.items():
+        feature = outbox.get_feature(alert_id, state)
+        if feature is None:
+            continue
+        print(f"Retrying {len(rows)} deliveries of alert: {alert_id}")
+        try:
+            _deliver_claimed(WXAlert(feature, state), rows)
+        except Exception as e:
+            print(e)
+            traceback.print_exception(*sys.exc_info())
+    outbox.purge(get_config().get('outbox', 'retention'))
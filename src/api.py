@@ -1,11 +1,19 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
 import sys
-from threading import Thread
+from threading import Event, Lock, Thread
 import traceback
 import time
 
 from .config import get_config
+from .leases import LeaseManager
+from .metrics import increment
 from .orm import ActiveAlerts, Installation
+from .outbox import get_outbox
+from .scheduler import NWSRequestError, PollScheduler, parse_retry_after
 
+import aiohttp
 import requests
 
 _wx_watcher_manager = None
@@ -21,19 +29,85 @@ def get_wx_watcher_manager():
 class WXWatcherManager():
     def __init__(self):
         self._watchers = []
+        self._lock = Lock()
+        self._national_watcher = None
+        self._engine = None
+        self._leases = None
+        if get_config().get('watcher', 'engine') == 'asyncio':
+            self._engine = AsyncWXWatcherEngine()
+        if get_config().get('watcher', 'mode') == 'national':
+            self._national_watcher = NationalWXWatcher()
+        if get_config().get('leases', 'enabled'):
+            # The lease manager loads the subscribed states itself and only
+            # hands us the ones this node should watch
+            self._leases = LeaseManager(self._on_lease_acquired, self._on_lease_released)
+            self._leases.start()
+            return
         for installation in Installation.bot_started_index.query(True):
             print(f"Adding watcher for {installation.state}")
             self.add_and_start_watcher(WXWatcher(installation.state))
 
     def add_and_start_watcher(self, watcher):
-        for w in self._watchers:
-            if w.state == watcher.state:
-                print(f"Watcher for {watcher.state} already exists")
+        if self._leases is not None:
+            self._leases.add_state(watcher.state)
+            return
+        with self._lock:
+            for w in self._watchers:
+                if w.state == watcher.state:
+                    print(f"Watcher for {watcher.state} already exists")
+                    return
+            self._watchers.append(watcher)
+        self._activate(watcher)
+
+    def _on_lease_acquired(self, state):
+        watcher = WXWatcher(state)
+        with self._lock:
+            if any(w.state == state for w in self._watchers):
                 return
-        self._watchers.append(watcher)
-        self._watchers[-1].watch()
+            self._watchers.append(watcher)
+        print(f"Adding watcher for {state}")
+        self._activate(watcher)
+
+    def _on_lease_released(self, state):
+        print(f"Removing watcher for {state}")
+        with self._lock:
+            watchers = [w for w in self._watchers if w.state == state]
+            self._watchers = [w for w in self._watchers if w.state != state]
+        for watcher in watchers:
+            self._deactivate(watcher)
+
+    def _activate(self, watcher):
+        if self._national_watcher is not None:
+            # The national watcher does the polling and hands each state its alerts
+            self._national_watcher.subscribe(watcher)
+            self._start(self._national_watcher)
+        else:
+            self._start(watcher)
+
+    def _deactivate(self, watcher):
+        if self._national_watcher is not None:
+            self._national_watcher.unsubscribe(watcher)
+        elif self._engine is not None:
+            self._engine.remove(watcher)
+        else:
+            watcher.stop()
+
+    def _start(self, watcher):
+        if self._engine is not None:
+            self._engine.add(watcher)
+        else:
+            watcher.watch()
 
     def stop(self):
+        if self._leases is not None:
+            # Hand our states to the other nodes right away rather than after the lease expires
+            self._leases.stop()
+        if self._engine is not None:
+            self._engine.stop()
+            return
+        if self._national_watcher is not None:
+            self._national_watcher.stop()
+            return
         for watcher in self._watchers:
             watcher.stop()
 
@@ -41,37 +115,121 @@ class WXWatcherManager():
 class WXWatcher():
     def __init__(self, state):
         self._thread = Thread(target=self._watch_loop)
+        self._stop_event = Event()
         self.state = state
+        self.scheduler = PollScheduler()
+        # Validators from the last successful response, sent back so that
+        # api.weather.gov can answer with a 304 when nothing has changed
+        self._etag = None
+        self._last_modified = None
+        # Validators of a response that is still being processed. They are only
+        # sent back once it has been, otherwise a failure would be skipped by a 304
+        self._pending_validators = None
+        # Alert IDs known to be recorded in ActiveAlerts, and the IDs from the
+        # last feed, so unchanged feeds need no DynamoDB round trips at all
+        self._seen_ids = set()
+        self._feed_ids = None
+        self._last_sweep = 0
+
+    def _alerts_url(self):
+        return 'https://api.weather.gov/alerts/active?area={}&status=actual'.format(self.state)
+
+    def _request_headers(self):
+        headers = {
+            'Accept': 'application/geo+json',
+            'User-Agent': get_config().get('nws', 'user_agent')
+        }
+        if self._etag is not None:
+            headers['If-None-Match'] = self._etag
+        if self._last_modified is not None:
+            headers['If-Modified-Since'] = self._last_modified
+        return headers
+
+    def _store_validators(self, headers):
+        self._pending_validators = (headers.get('ETag'), headers.get('Last-Modified'))
+
+    def _commit_validators(self):
+        if self._pending_validators is not None:
+            self._etag, self._last_modified = self._pending_validators
+            self._pending_validators = None
 
     def _get_alerts_geojson(self):
-        url = 'https://api.weather.gov/alerts/active?area={}&status=actual'.format(self.state)
+        # Returns None if the feed has not changed since the last request
         response = requests.get(
-            url,
-            headers={
-                'Accept': 'application/geo+json',
-                'User-Agent': get_config().get('nws', 'user_agent')
-            }
+            self._alerts_url(),
+            headers=self._request_headers()
         )
-        return response.json()
-
-    def _seen_alert(self, alert_id):
-        # Query for state and ID in ActiveAlerts
-        res = None
-        for res_ in ActiveAlerts.query(alert_id):
-            res = res_
-            break
-        if res is None:
-            # Add to ActiveAlerts
-            ActiveAlerts(
-                id=alert_id,
-                state=self.state
-            ).save()
-            return False
-        else:
-            return True
+        increment('nws_alert_requests')
+        if response.status_code == 304:
+            increment('nws_alert_not_modified')
+            return None
+        if response.status_code == 429 or response.status_code >= 500:
+            increment('nws_alert_errors')
+            raise NWSRequestError(response.status_code, parse_retry_after(response.headers.get('Retry-After')))
+        alertsJSON = response.json()
+        if response.status_code == 200:
+            self._store_validators(response.headers)
+        return alertsJSON
+
+    def _sweep_alerts(self, feed_ids):
+        # Expired alerts are removed by the DynamoDB TTL on expires_at, this
+        # only catches alerts that were cancelled early or were stored without
+        # an expiry, so it doesn't need to run on every poll
+        if time.time() - self._last_sweep < get_config().get('watcher', 'sweep_interval'):
+            return
+        self._last_sweep = time.time()
+        expired_alert_ids = set(alert.id for alert in ActiveAlerts.state_index.query(self.state)) - feed_ids
+        with ActiveAlerts.batch_write() as batch:
+            for alert_id in expired_alert_ids:
+                print('Removing expired alert: {}'.format(alert_id))
+                batch.delete(ActiveAlerts(id=alert_id))
+
+    def _new_alert_ids(self, features_by_id):
+        unknown_ids = set(features_by_id) - self._seen_ids
+        if unknown_ids:
+            # These may still have been recorded by a previous run or another watcher
+            for alert in ActiveAlerts.batch_get(unknown_ids):
+                self._seen_ids.add(alert.id)
+        new_ids = unknown_ids - self._seen_ids
+        if new_ids:
+            # Recorded locally first, so a crash after marking them as seen can't lose them
+            get_outbox().add_alerts(self.state, [features_by_id[alert_id] for alert_id in new_ids])
+        with ActiveAlerts.batch_write() as batch:
+            for alert_id in new_ids:
+                batch.save(ActiveAlerts(
+                    id=alert_id,
+                    state=self.state,
+                    expires_at=get_alert_expiry(features_by_id[alert_id])
+                ))
+        self._seen_ids = (self._seen_ids | new_ids) & set(features_by_id)
+        return new_ids
+
+    def _new_features(self, features):
+        features_by_id = {feature['properties']['id']: feature for feature in features}
+        feed_ids = set(features_by_id)
+        if feed_ids == self._feed_ids:
+            # Same alerts as the last poll, all of them have already been handled
+            return []
+        self._sweep_alerts(feed_ids)
+        new_ids = self._new_alert_ids(features_by_id)
+        self._feed_ids = feed_ids
+
+        new_features = []
+        for feature in features:
+            if feature['properties']['id'] in new_ids:
+                new_features.append(feature)
+            else:
+                print('Already seen alert: {}'.format(feature['properties']['id']))
+        return new_features
 
     def _process_alerts(self):
         alertsJSON = self._get_alerts_geojson()
+        if alertsJSON is None:
+            # Nothing changed since the last poll, so there are no new or expired alerts
+            return []
+        self._process_geojson(alertsJSON)
+
+    def _process_geojson(self, alertsJSON):
         if 'type' not in alertsJSON or alertsJSON['type'] != 'FeatureCollection':
             print('Invalid GeoJSON FeatureCollection')
             return []
@@ -80,34 +238,25 @@ class WXWatcher():
             print('No alerts found')
             return []
 
-        # Check the db for all alerts with the same state. If alerts in the db aren't in the
-        # API response, they have expired and should be removed from the db.
-        # Get all the alerts for the state
-        state_alerts = ActiveAlerts.state_index.query(self.state)
-        # Get the IDs of the alerts in the API response
-        api_alert_ids = [feature['properties']['id'] for feature in alertsJSON['features']]
-        # Get the IDs of the alerts in the db
-        db_alert_ids = [alert.id for alert in state_alerts]
-        # Get the IDs of the alerts that are in the db but not in the API response
-        expired_alert_ids = [alert_id for alert_id in db_alert_ids if alert_id not in api_alert_ids]
-        # Delete the expired alerts from the db
-        for alert_id in expired_alert_ids:
-            print('Removing expired alert: {}'.format(alert_id))
-            for alert in ActiveAlerts.query(alert_id):
-                alert.delete()
-
-        for feature in alertsJSON['features']:
+        self.scheduler.record_alerts(alertsJSON['features'])
+        if self._process_features(alertsJSON['features']):
+            self._commit_validators()
+
+    def _process_features(self, features):
+        # Returns False if some of the feed has to be processed again
+        for feature in self._new_features(features):
             from .alert import WXAlert
-            if not self._seen_alert(feature['properties']['id']):
-                alert = WXAlert(feature, self.state)
-                print('New alert: {}'.format(alert.id))
-                from .alert import send_alert
-                send_alert(alert)
-            else:
-                print('Already seen alert: {}'.format(feature['properties']['id']))
+            alert = WXAlert(feature, self.state)
+            print('New alert: {}'.format(alert.id))
+            from .alert import send_alert
+            send_alert(alert)
+        return True
 
     def _get_alerts(self):
         alertsJSON = self._get_alerts_geojson()
+        if alertsJSON is None:
+            return []
+
         if 'type' not in alertsJSON or alertsJSON['type'] != 'FeatureCollection':
             print('Invalid GeoJSON FeatureCollection')
             return []
@@ -116,43 +265,30 @@ class WXWatcher():
             print('No alerts found')
             return []
 
-        # Check the db for all alerts with the same state. If alerts in the db aren't in the
-        # API response, they have expired and should be removed from the db.
-        # Get all the alerts for the state
-        state_alerts = ActiveAlerts.state_index.query(self.state)
-        # Get the IDs of the alerts in the API response
-        api_alert_ids = [feature['properties']['id'] for feature in alertsJSON['features']]
-        # Get the IDs of the alerts in the db
-        db_alert_ids = [alert.id for alert in state_alerts]
-        # Get the IDs of the alerts that are in the db but not in the API response
-        expired_alert_ids = [alert_id for alert_id in db_alert_ids if alert_id not in api_alert_ids]
-        # Delete the expired alerts from the db
-        for alert_id in expired_alert_ids:
-            print('Removing expired alert: {}'.format(alert_id))
-            for alert in ActiveAlerts.query(alert_id):
-                alert.delete()
-
         alerts = []
-        for feature in alertsJSON['features']:
+        for feature in self._new_features(alertsJSON['features']):
             from .alert import WXAlert
-            if not self._seen_alert(feature['properties']['id']):
-                alert = WXAlert(feature, self.state)
-                print('New alert: {}'.format(alert.id))
-                alerts.append(alert)
-            else:
-                print('Already seen alert: {}'.format(feature['properties']['id']))
+            alert = WXAlert(feature, self.state)
+            print('New alert: {}'.format(alert.id))
+            alerts.append(alert)
+        self._commit_validators()
         return alerts
 
     def _watch_loop(self):
-        try:
-            while True:
-                time_start = time.time()
+        self._stop_event.wait(self.scheduler.first_delay())
+        while not self._stop_event.is_set():
+            time_start = time.time()
+            try:
                 self._process_alerts()
-                time.sleep(max(0, 30 - (time.time() - time_start)))
-        except Exception as e:
-            print(e)
-            traceback.print_exception(*sys.exc_info())
-            self._watch_loop()
+                self.scheduler.record_success()
+            except NWSRequestError as e:
+                print(e)
+                self.scheduler.record_error(e.retry_after)
+            except Exception as e:
+                print(e)
+                traceback.print_exception(*sys.exc_info())
+                self.scheduler.record_error()
+            self._stop_event.wait(self.scheduler.next_delay(time.time() - time_start))
 
     def watch(self):
         if self._thread is not None and self._thread.is_alive():
@@ -160,11 +296,175 @@ class WXWatcher():
             return
         if self._thread is None:
             self._thread = Thread(target=self._watch_loop)
+        self._stop_event.clear()
         self._thread.start()
 
     def stop(self):
         if self._thread is None or not self._thread.is_alive():
             print('WXWatcher not running')
             return
+        self._stop_event.set()
         self._thread.join(timeout=1)
         self._thread = None
+
+
+def get_alert_expiry(feature):
+    # The later of the message expiry and the end of the event, or None if the alert has neither
+    times = []
+    for key in ['expires', 'ends']:
+        if feature['properties'].get(key):
+            times.append(datetime.fromisoformat(feature['properties'][key]))
+    if not times:
+        return None
+    return max(times)
+
+
+def get_feature_states(feature):
+    # UGC codes look like "OKC109" (county) or "OKZ025" (zone), the first two
+    # letters are the state. Marine zones use non-state prefixes and are ignored
+    # by the watchers since nobody can subscribe to them.
+    states = set()
+    geocode = feature['properties'].get('geocode') or {}
+    for ugc in geocode.get('UGC', []):
+        states.add(ugc[:2])
+    return states
+
+
+class NationalWXWatcher(WXWatcher):
+    """
+    Polls the nationwide alert feed once per cycle and hands each subscribed
+    state watcher the alerts that affect it
+    """
+
+    def __init__(self):
+        super().__init__(None)
+        self._subscribers = {}
+        self._lock = Lock()
+
+    def subscribe(self, watcher):
+        with self._lock:
+            self._subscribers[watcher.state] = watcher
+
+    def unsubscribe(self, watcher):
+        with self._lock:
+            if self._subscribers.get(watcher.state) is watcher:
+                del self._subscribers[watcher.state]
+
+    def _alerts_url(self):
+        return 'https://api.weather.gov/alerts/active?status=actual'
+
+    def _process_features(self, features):
+        features_by_state = {}
+        for feature in features:
+            for state in get_feature_states(feature):
+                features_by_state.setdefault(state, []).append(feature)
+
+        with self._lock:
+            subscribers = list(self._subscribers.values())
+        failed = False
+        for watcher in subscribers:
+            try:
+                # States without alerts still get an empty list so that expired alerts are cleaned up
+                watcher._process_features(features_by_state.get(watcher.state, []))
+            except Exception as e:
+                print(e)
+                traceback.print_exception(*sys.exc_info())
+                failed = True
+        # The validators stay pending so the feed is fetched and processed again,
+        # states that did succeed skip the alerts they already handled. The fetch
+        # itself worked, so the other states don't back off along with the failed one
+        return not failed
+
+
+class AsyncWXWatcherEngine():
+    """
+    Runs every watcher as a task on a single asyncio event loop, sharing one
+    aiohttp connection pool instead of a thread and connection per state
+    """
+
+    def __init__(self):
+        self._loop = asyncio.new_event_loop()
+        self._session = None
+        self._tasks = {}
+        # Alert processing talks to DynamoDB, renders maps and posts to Slack, all
+        # of which block, so it runs on a small pool rather than on the event loop
+        self._executor = ThreadPoolExecutor(
+            max_workers=get_config().get('watcher', 'workers'),
+            thread_name_prefix='wx-watcher',
+        )
+        self._thread = Thread(target=self._run_loop)
+        self._thread.start()
+
+    def _run_loop(self):
+        asyncio.set_event_loop(self._loop)
+        self._loop.run_forever()
+
+    def add(self, watcher):
+        asyncio.run_coroutine_threadsafe(self._add(watcher), self._loop).result()
+
+    async def _add(self, watcher):
+        if watcher in self._tasks:
+            return
+        if self._session is None:
+            self._session = aiohttp.ClientSession()
+        self._tasks[watcher] = self._loop.create_task(self._watch(watcher))
+
+    def remove(self, watcher):
+        asyncio.run_coroutine_threadsafe(self._remove(watcher), self._loop).result()
+
+    async def _remove(self, watcher):
+        task = self._tasks.pop(watcher, None)
+        if task is not None:
+            task.cancel()
+
+    async def _get_alerts_geojson(self, watcher):
+        async with self._session.get(watcher._alerts_url(), headers=watcher._request_headers()) as response:
+            increment('nws_alert_requests')
+            if response.status == 304:
+                increment('nws_alert_not_modified')
+                return None
+            if response.status == 429 or response.status >= 500:
+                increment('nws_alert_errors')
+                raise NWSRequestError(response.status, parse_retry_after(response.headers.get('Retry-After')))
+            alertsJSON = await response.json(content_type=None)
+            if response.status == 200:
+                watcher._store_validators(response.headers)
+            return alertsJSON
+
+    async def _watch(self, watcher):
+        await asyncio.sleep(watcher.scheduler.first_delay())
+        while True:
+            time_start = time.time()
+            try:
+                alertsJSON = await self._get_alerts_geojson(watcher)
+                if alertsJSON is not None:
+                    await self._loop.run_in_executor(self._executor, watcher._process_geojson, alertsJSON)
+                watcher.scheduler.record_success()
+            except asyncio.CancelledError:
+                raise
+            except NWSRequestError as e:
+                print(e)
+                watcher.scheduler.record_error(e.retry_after)
+            except Exception as e:
+                print(e)
+                traceback.print_exception(*sys.exc_info())
+                watcher.scheduler.record_error()
+            await asyncio.sleep(watcher.scheduler.next_delay(time.time() - time_start))
+
+    async def _shutdown(self):
+        for task in self._tasks.values():
+            task.cancel()
+        await asyncio.gather(*self._tasks.values(), return_exceptions=True)
+        self._tasks = {}
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    def stop(self):
+        if not self._thread.is_alive():
+            print('AsyncWXWatcherEngine not running')
+            return
+        asyncio.run_coroutine_threadsafe(self._shutdown(), self._loop).result()
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+        self._executor.shutdown(wait=False)
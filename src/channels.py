@@ -0,0 +1,55 @@
+from threading import Lock
+import time
+
+from .config import get_config
+
+_channel_directory = None
+
+
+def get_channel_directory():
+    global _channel_directory
+    if _channel_directory is None:
+        _channel_directory = ChannelDirectory(get_config().get('slack', 'channel_refresh_interval'))
+    return _channel_directory
+
+
+class ChannelDirectory():
+    """
+    Caches the channels the bot is a member of in each workspace. Entries are
+    invalidated by membership events and refreshed after refresh_interval
+    seconds in case an event was missed
+    """
+
+    def __init__(self, refresh_interval):
+        self._refresh_interval = refresh_interval
+        self._channels = {}
+        self._lock = Lock()
+
+    def _fetch(self, client):
+        # users.conversations only returns channels the bot is in, so there is no
+        # need to page through every channel in the workspace
+        channels = []
+        cursor = None
+        while True:
+            response = client.users_conversations(exclude_archived=True, limit=1000, cursor=cursor)
+            for channel in response['channels']:
+                if not channel.get('is_archived') and not channel.get('is_im'):
+                    channels.append(channel['id'])
+            cursor = response.get('response_metadata', {}).get('next_cursor')
+            if not cursor:
+                break
+        return channels
+
+    def get_channels(self, team_id, client):
+        with self._lock:
+            entry = self._channels.get(team_id)
+        if entry is not None and time.time() - entry[0] < self._refresh_interval:
+            return entry[1]
+        channels = self._fetch(client)
+        with self._lock:
+            self._channels[team_id] = (time.time(), channels)
+        return channels
+
+    def invalidate(self, team_id):
+        with self._lock:
+            self._channels.pop(team_id, None)
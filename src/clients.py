@@ -0,0 +1,82 @@
+import http.client
+import io
+from threading import Lock
+from urllib.error import HTTPError
+
+from .config import get_config
+
+import requests
+from slack_sdk import WebClient
+
+_web_client_pool = None
+
+
+def get_web_client_pool():
+    global _web_client_pool
+    if _web_client_pool is None:
+        _web_client_pool = WebClientPool()
+    return _web_client_pool
+
+
+def get_client(team_id, token):
+    return get_web_client_pool().get(team_id, token)
+
+
+class PooledWebClient(WebClient):
+    """
+    WebClient that sends its API calls over a persistent requests.Session, so
+    TLS connections to slack.com are kept alive between calls instead of being
+    set up again by urllib for every request
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_maxsize=get_config().get('slack', 'delivery_workers'))
+        self._session.mount('https://', adapter)
+
+    def _perform_urllib_http_request_internal(self, url, req):
+        # Header values from slack_sdk can be ints (Content-Length), requests only takes strings
+        headers = {key: str(value) for key, value in req.header_items()}
+        resp = self._session.post(url, data=req.data, headers=headers, timeout=self.timeout)
+        if resp.status_code >= 400:
+            # slack_sdk handles error statuses, including 429 Retry-After, from urllib's HTTPError
+            message = http.client.HTTPMessage()
+            for key, value in resp.headers.items():
+                message[key] = value
+            raise HTTPError(url, resp.status_code, resp.reason, message, io.BytesIO(resp.content))
+        return {"status": resp.status_code, "headers": resp.headers, "body": resp.text}
+
+    def upload_and_share(self, *, content, filename, title, channel_ids):
+        # files_upload_v2 can only share to a single channel, so this does its three
+        # steps by hand and shares the one upload with every channel at once
+        url_response = self.files_getUploadURLExternal(filename=filename, length=len(content))
+        resp = self._session.post(url_response['upload_url'], data=content, timeout=self.timeout)
+        if resp.status_code != 200:
+            raise ValueError(f"Failed to upload {filename}: {resp.status_code} {resp.text}")
+        return self.files_completeUploadExternal(
+            files=[{"id": url_response['file_id'], "title": title}],
+            channels=",".join(channel_ids),
+        )
+
+
+class WebClientPool():
+    """
+    Keeps one PooledWebClient per workspace, replacing it when the token changes
+    """
+
+    def __init__(self):
+        self._clients = {}
+        self._lock = Lock()
+
+    def get(self, team_id, token):
+        with self._lock:
+            client = self._clients.get(team_id)
+            if client is None or client.token != token:
+                client = PooledWebClient(token=token)
+                self._clients[team_id] = client
+            return client
+
+    def refresh(self, team_id, token):
+        with self._lock:
+            self._clients[team_id] = PooledWebClient(token=token)
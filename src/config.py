@@ -8,17 +8,131 @@ _default_config = {
         'client_id': '',
         'client_secret': '',
         'signing_secret': '',
+        # Seconds before the cached list of channels the bot is in is fetched again
+        'channel_refresh_interval': 3600,
+        # Seconds before the in-memory copy of the installations table is loaded again
+        'subscriber_refresh_interval': 3600,
+        # Concurrent Slack deliveries
+        'delivery_workers': 8,
+        # Calls per minute allowed per workspace for each WebClient method
+        'rate_limits': {
+            'chat_postMessage': 60,
+            'chat_update': 50,
+            'files_upload_v2': 20,
+            'upload_and_share': 20,
+            'default': 20,
+        },
+        # "shared" uploads each image once per workspace and shares it to all of its
+        # channels, "per_channel" uploads it separately to every channel
+        'upload_mode': 'shared',
+        # "upload" sends images with the files API, "s3" stores each image once in
+        # s3.bucket and links it from an image block in the message. Without
+        # s3.image_base_url those links stop working when the signing credentials
+        # expire, so "s3" is only meant for deployments that set it
+        'image_delivery': 'upload',
+        # Times a call rate limited by Slack is retried after its Retry-After
+        'max_retries': 3,
+        # Processes drawing images for /radar and /spc in each web worker. Each one
+        # imports Cartopy, MetPy and AWIPS and keeps its own base maps, and the ECS
+        # task's 1536 MB is shared by both gunicorn workers, the watcher and SPC runs
+        'render_workers': 1,
     },
     'nws': {
         'user_agent': '',
     },
+    'watcher': {
+        # "state" polls api.weather.gov once per state, "national" polls the
+        # nationwide feed once and routes alerts to each state
+        'mode': 'state',
+        # "thread" runs a thread per watcher, "asyncio" runs every watcher on one event loop
+        'engine': 'thread',
+        # Threads used by the asyncio engine to process alerts
+        'workers': 4,
+        # Seconds between sweeps of ActiveAlerts for alerts that left the feed early
+        'sweep_interval': 3600,
+        # Seconds between polls normally, while fast_poll_events are active and while there are no alerts
+        'interval': 30,
+        'min_interval': 10,
+        'quiet_interval': 60,
+        # Upper bound in seconds for the exponential backoff after errors
+        'max_backoff': 300,
+        # Fraction of the delay added or removed at random so watchers don't poll in lockstep
+        'jitter': 0.1,
+        'fast_poll_events': ['Tornado Warning', 'Severe Thunderstorm Warning'],
+        # Unix socket the web workers use to reach the watcher process
+        'control_socket': '/tmp/nws-slack-bot.sock',
+    },
+    'events': {
+        # Per-event replacements for the color, radar, priority and category in src/events.py
+        'overrides': {},
+    },
+    'metrics': {
+        # Seconds between the watcher process logging its counters and timings
+        'log_interval': 300,
+    },
+    'maps': {
+        # Base map figures from .states kept in memory, least recently used are dropped first.
+        # Each state raster is about 20 MB, held by the watcher and the SPC scripts
+        'template_cache_size': 4,
+        # Base maps kept by each /radar and /spc render process
+        'render_template_cache_size': 1,
+        # Site table from scripts/generate_radar_sites.py used to find the closest radar
+        'radar_sites': '.states/radar_sites.json',
+        # Ask the api.weather.gov points endpoint when the site table has no answer
+        'radar_points_fallback': True,
+        # Bytes per ranged GET while reading the first sweep of a Level II volume
+        'level2_chunk_size': 1024 * 1024,
+    },
+    'outbox': {
+        # SQLite database of alerts and channel deliveries that haven't finished yet
+        'path': '.outbox.sqlite3',
+        # Attempts at a delivery, or replays of an alert that was never expanded, before it is given up on
+        'max_attempts': 5,
+        # Seconds before the first retry, doubled after every further failure
+        'retry_interval': 30,
+        # Seconds a delivery stays claimed by the worker sending it
+        'claim_timeout': 300,
+        # Seconds between replays of the outbox
+        'drain_interval': 30,
+        # Seconds finished alerts and deliveries are kept, which is also how long
+        # an Update or Cancel can still find the message it edits
+        'retention': 7 * 24 * 60 * 60,
+    },
+    'zones': {
+        'cache_dir': '.zones',
+        # Seconds before a cached zone geometry is revalidated with api.weather.gov
+        'max_age': 7 * 24 * 60 * 60,
+        # Concurrent requests used to fetch uncached zones
+        'workers': 8,
+        # Zone shapes kept in memory, least recently used are dropped first and read from disk again
+        'memory_entries': 1000,
+    },
     's3': {
         'bucket': '',
+        # Endpoint override, such as http://localhost:9000 for a local S3 stand-in
+        'endpoint_url': '',
+        # Key prefix for images stored under the SHA-256 of their contents
+        'image_prefix': 'images/',
+        # Public URL the image keys are served from, presigned URLs are used if empty.
+        # The Terraform bucket is encrypted with SSE-KMS, which anonymous reads can't
+        # decrypt, so this has to be a CloudFront distribution allowed to use the key
+        'image_base_url': '',
     },
     'dynamodb': {
         'installations_table': '',
         'active_alerts_table': '',
+        'lease_table': '',
         'region': '',
+        # Endpoint override, such as http://localhost:8000 for DynamoDB Local
+        'host': '',
+    },
+    'leases': {
+        # Split states between several watcher processes using leases in dynamodb.lease_table
+        'enabled': False,
+        # Seconds a lease is held without a heartbeat
+        'ttl': 30,
+        # Seconds between reloads of the subscribed states from the installations table
+        'resync_interval': 300,
     }
 }
 
@@ -0,0 +1,75 @@
+import json
+import os
+import socket
+import socketserver
+import sys
+from threading import Thread
+import traceback
+
+from .config import get_config
+
+
+def send_control_message(message):
+    # Sends one message to the watcher process. Returns False if it isn't reachable,
+    # in which case it will still pick the change up from DynamoDB when it restarts
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.settimeout(1)
+            sock.connect(get_config().get('watcher', 'control_socket'))
+            sock.sendall(json.dumps(message).encode() + b'\n')
+        return True
+    except OSError as e:
+        print(f"Error sending control message: {e}")
+        return False
+
+
+class ControlServer():
+    """
+    Receives newline-delimited JSON messages from the web workers on a local
+    socket and dispatches them by their "op" to the registered handlers
+    """
+
+    def __init__(self):
+        self._handlers = {}
+        self._path = get_config().get('watcher', 'control_socket')
+        self._server = None
+        self._thread = None
+
+    def register(self, op, handler):
+        self._handlers[op] = handler
+
+    def _dispatch(self, line):
+        try:
+            message = json.loads(line)
+            if message.get('op') not in self._handlers:
+                print(f"Unknown control message: {message}")
+                return
+            self._handlers[message['op']](message)
+        except Exception as e:
+            print(e)
+            traceback.print_exception(*sys.exc_info())
+
+    def start(self):
+        server = self
+
+        class Handler(socketserver.StreamRequestHandler):
+            def handle(self):
+                for line in self.rfile:
+                    server._dispatch(line)
+
+        if os.path.exists(self._path):
+            os.unlink(self._path)
+        self._server = socketserver.ThreadingUnixStreamServer(self._path, Handler)
+        self._server.daemon_threads = True
+        self._thread = Thread(target=self._server.serve_forever)
+        self._thread.start()
+
+    def stop(self):
+        if self._server is None:
+            print('ControlServer not running')
+            return
+        self._server.shutdown()
+        self._server.server_close()
+        self._thread.join()
+        self._server = None
+        os.unlink(self._path)
@@ -0,0 +1,125 @@
+from concurrent.futures import ThreadPoolExecutor
+import sys
+from threading import Lock, local
+import time
+import traceback
+
+from .config import get_config
+from .metrics import increment, observe
+
+from slack_sdk.errors import SlackApiError
+
+# Calls that put a message or file in a channel, timed from when their job was queued
+MESSAGE_METHODS = ['chat_postMessage', 'chat_update', 'files_upload_v2', 'upload_and_share']
+
+_delivery_queue = None
+
+
+def get_delivery_queue():
+    global _delivery_queue
+    if _delivery_queue is None:
+        _delivery_queue = DeliveryQueue(
+            get_config().get('slack', 'delivery_workers'),
+            get_config().get('slack', 'rate_limits'),
+            get_config().get('slack', 'max_retries'),
+        )
+    return _delivery_queue
+
+
+class TokenBucket():
+    """
+    Allows per_minute calls per minute with bursts of up to ten seconds' worth
+    """
+
+    def __init__(self, per_minute):
+        self._rate = per_minute / 60
+        self._capacity = max(1, self._rate * 10)
+        self._tokens = self._capacity
+        self._updated = time.monotonic()
+        self._paused_until = 0
+        self._lock = Lock()
+
+    def acquire(self):
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                if now < self._paused_until:
+                    wait = self._paused_until - now
+                else:
+                    self._tokens = min(self._capacity, self._tokens + (now - self._updated) * self._rate)
+                    self._updated = now
+                    if self._tokens >= 1:
+                        self._tokens -= 1
+                        return
+                    wait = (1 - self._tokens) / self._rate
+            time.sleep(wait)
+
+    def pause(self, seconds):
+        # Slack told us to back off, so nobody gets a token until Retry-After has passed
+        with self._lock:
+            self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+            self._tokens = 0
+            self._updated = self._paused_until
+
+
+class DeliveryQueue():
+    """
+    Runs Slack deliveries on a bounded pool of workers so one slow workspace
+    doesn't hold up the rest. Every Web API call goes through a token bucket
+    per workspace and method, and 429s are retried after their Retry-After
+    """
+
+    def __init__(self, workers, rate_limits, max_retries):
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='slack-delivery')
+        self._rate_limits = rate_limits
+        self._max_retries = max_retries
+        self._buckets = {}
+        self._lock = Lock()
+        # When the job running on this worker thread was submitted
+        self._job = local()
+
+    def _bucket(self, team_id, method):
+        with self._lock:
+            if (team_id, method) not in self._buckets:
+                per_minute = self._rate_limits.get(method, self._rate_limits['default'])
+                self._buckets[(team_id, method)] = TokenBucket(per_minute)
+            return self._buckets[(team_id, method)]
+
+    def call(self, team_id, client, method, **kwargs):
+        bucket = self._bucket(team_id, method)
+        attempt = 0
+        while True:
+            bucket.acquire()
+            try:
+                response = getattr(client, method)(**kwargs)
+                enqueued = getattr(self._job, 'enqueued', None)
+                if method in MESSAGE_METHODS and enqueued is not None:
+                    observe('slack_delivery_latency', time.time() - enqueued)
+                return response
+            except SlackApiError as e:
+                if e.response.status_code != 429 or attempt >= self._max_retries:
+                    raise
+                increment('slack_rate_limited')
+                bucket.pause(int(e.response.headers.get('Retry-After', 1)))
+                attempt += 1
+
+    def submit(self, job, *args, **kwargs):
+        enqueued = time.time()
+
+        def run():
+            self._job.enqueued = enqueued
+            try:
+                return job(*args, **kwargs)
+            finally:
+                self._job.enqueued = None
+        return self._executor.submit(run)
+
+
+def wait_for_deliveries(futures):
+    # A failed channel is logged but doesn't stop delivery to the others
+    for future in futures:
+        try:
+            future.result()
+        except Exception as e:
+            print(f"Error posting message: {e}")
+            traceback.print_exception(*sys.exc_info())
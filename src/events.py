@@ -0,0 +1,80 @@
+from collections import namedtuple
+
+from .config import get_config
+
+# color: fill/outline color used on the map
+# radar: whether the closest radar is drawn under the alert
+# priority: 1 is an immediate threat to life, 2 other warnings, 3 watches, 4 statements and advisories
+# category: "weather" for meteorological and hydrological events, otherwise "civil" or "hazard"
+EventPolicy = namedtuple('EventPolicy', ['color', 'radar', 'priority', 'category'])
+
+DEFAULT_POLICY = EventPolicy("#FD6347", False, 4, "other")
+
+# Event codes: https://www.weather.gov/nwr/eventcodes
+# https://www.weather.gov/help-map
+_event_policies = {
+    "Blizzard Warning": EventPolicy("#FF4500", True, 2, "weather"),
+    "Coastal Flood Watch": EventPolicy("#66CDAA", False, 3, "weather"),
+    "Coastal Flood Warning": EventPolicy("#228B22", True, 2, "weather"),
+    "Dust Storm Warning": EventPolicy("#FFE4C4", True, 1, "weather"),
+    "Extreme Wind Warning": EventPolicy("#FF8C00", False, 1, "weather"),
+    "Flash Flood Watch": EventPolicy("#2E8B57", False, 3, "weather"),
+    "Flash Flood Warning": EventPolicy("#8B0000", True, 1, "weather"),
+    "Flash Flood Statement": EventPolicy("#8B0000", True, 4, "weather"),
+    "Flood Advisory": EventPolicy("#FD6347", True, 4, "weather"),
+    "Flood Watch": EventPolicy("#2E8B57", False, 3, "weather"),
+    "Flood Warning": EventPolicy("#00FF00", True, 2, "weather"),
+    "Flood Statement": EventPolicy("#00FF00", True, 4, "weather"),
+    "High Wind Watch": EventPolicy("#B8860B", False, 3, "weather"),
+    "High Wind Warning": EventPolicy("#DAA520", False, 2, "weather"),
+    "Hurricane Watch": EventPolicy("#FF00FF", False, 3, "weather"),
+    "Hurricane Warning": EventPolicy("#DC143C", True, 1, "weather"),
+    "Hurricane Statement": EventPolicy("#FFE4B5", True, 4, "weather"),
+    "Severe Thunderstorm Watch": EventPolicy("#DB7093", False, 3, "weather"),
+    "Severe Thunderstorm Warning": EventPolicy("#FFA500", True, 1, "weather"),
+    "Severe Weather Statement": EventPolicy("#00FFFF", True, 4, "weather"),
+    "Snow Squall Warning": EventPolicy("#C71585", True, 1, "weather"),
+    "Special Marine Warning": EventPolicy("#FFA500", True, 2, "weather"),
+    "Special Weather Statement": EventPolicy("#FFE4B5", True, 4, "weather"),
+    "Storm Surge Watch": EventPolicy("#DB7FF7", False, 3, "weather"),
+    "Storm Surge Warning": EventPolicy("#B524F7", True, 1, "weather"),
+    "Tornado Watch": EventPolicy("#FFFF00", False, 3, "weather"),
+    "Tornado Warning": EventPolicy("#FF0000", True, 1, "weather"),
+    "Tropical Storm Watch": EventPolicy("#F08080", False, 3, "weather"),
+    "Tropical Storm Warning": EventPolicy("#B22222", True, 2, "weather"),
+    "Tsunami Watch": EventPolicy("#FF00FF", False, 3, "weather"),
+    "Tsunami Warning": EventPolicy("#FD6347", False, 1, "weather"),
+    "Winter Storm Watch": EventPolicy("#4682B4", False, 3, "weather"),
+    "Winter Storm Warning": EventPolicy("#FF69B4", True, 2, "weather"),
+    "Avalanche Watch": EventPolicy("#F4A460", False, 3, "hazard"),
+    "Avalanche Warning": EventPolicy("#1E90FF", False, 2, "hazard"),
+    "Blue Alert": EventPolicy("#B0C4DE", False, 2, "civil"),
+    "Child Abduction Emergency": EventPolicy("#800000", False, 1, "civil"),
+    "Civil Danger Warning": EventPolicy("#FFB6C1", False, 1, "civil"),
+    "Civil Emergency Message": EventPolicy("#FFB6C1", False, 1, "civil"),
+    "Earthquake Warning": EventPolicy("#8B4513", False, 1, "hazard"),
+    "Evacuation Immediate": EventPolicy("#7FFF00", False, 1, "civil"),
+    "Fire Warning": EventPolicy("#A0522D", False, 1, "hazard"),
+    "Hazardous Materials Warning": EventPolicy("#4B0082", False, 1, "hazard"),
+    "Law Enforcement Warning": EventPolicy("#C0C0C0", False, 2, "civil"),
+    "Local Area Emergency": EventPolicy("#C0C0C0", False, 2, "civil"),
+    "911 Telephone Outage Emergency": EventPolicy("#C0C0C0", False, 2, "civil"),
+    "Nuclear Power Plant Warning": EventPolicy("#4B0082", False, 1, "hazard"),
+    "Radiological Hazard Warning": EventPolicy("#4B0082", False, 1, "hazard"),
+    "Shelter in Place Warning": EventPolicy("#FA8072", False, 1, "civil"),
+    "Volcano Warning": EventPolicy("#2F4F4F", False, 1, "hazard"),
+}
+
+
+def _apply_overrides(policies, overrides):
+    # Overrides come from the "events" config section, for example
+    # {"Tornado Warning": {"color": "#FF00FF"}, "Flood Advisory": {"radar": false}}
+    for event, override in overrides.items():
+        policies[event] = policies.get(event, DEFAULT_POLICY)._replace(**override)
+
+
+_apply_overrides(_event_policies, get_config().get('events', 'overrides'))
+
+
+def get_event_policy(event):
+    return _event_policies.get(event, DEFAULT_POLICY)
@@ -0,0 +1,148 @@
+from collections import OrderedDict
+from contextlib import contextmanager
+import io
+import json
+import os
+import pickle
+from threading import Lock
+
+from .config import get_config
+
+import cartopy.crs as ccrs
+import matplotlib.pyplot as plt
+import numpy as np
+from PIL import Image
+
+_figure_cache = None
+
+
+def get_figure_cache():
+    global _figure_cache
+    if _figure_cache is None:
+        _figure_cache = FigureTemplateCache(get_config().get('maps', 'template_cache_size'))
+    return _figure_cache
+
+
+def set_figure_cache_size(size):
+    # Render processes keep fewer base maps than the watcher
+    global _figure_cache
+    _figure_cache = FigureTemplateCache(size)
+
+
+def figure_to_png(fig):
+    buf = io.BytesIO()
+    fig.savefig(buf, format='png', bbox_inches='tight')
+    image = buf.getvalue()
+    buf.close()
+    return image
+
+
+class _Snapshot():
+    """
+    What a base map looks like before a render draws on it, so everything the
+    render added can be taken off again afterwards
+    """
+
+    def __init__(self, fig):
+        self.axes = list(fig.axes)
+        self.children = {ax: set(ax.get_children()) for ax in self.axes}
+        self.positions = {ax: (ax.get_position(original=True), ax.get_position(), ax.get_anchor()) for ax in self.axes}
+        # A gridspec colorbar replaces the parent's subplotspec with a shrunken one,
+        # the next colorbar would be cut from that and the map would keep shrinking
+        self.subplotspecs = {ax: ax.get_subplotspec() for ax in self.axes}
+        self.limits = {
+            ax: (ax.get_xlim(), ax.get_ylim(), ax.dataLim.frozen(), ax.get_autoscalex_on(), ax.get_autoscaley_on())
+            for ax in self.axes
+        }
+        self.titles = {ax: [(loc, ax.get_title(loc)) for loc in ['left', 'center', 'right']] for ax in self.axes}
+
+    def restore(self, fig):
+        for ax in list(fig.axes):
+            if ax not in self.axes:
+                # Colorbars get axes of their own
+                fig.delaxes(ax)
+        for ax in self.axes:
+            for child in ax.get_children():
+                if child not in self.children[ax]:
+                    child.remove()
+            original, active, anchor = self.positions[ax]
+            # A colorbar shrinks the map it belongs to
+            if self.subplotspecs[ax] is not None:
+                ax.set_subplotspec(self.subplotspecs[ax])
+            ax.set_position(original, which='original')
+            ax.set_position(active, which='active')
+            ax.set_anchor(anchor)
+            xlim, ylim, data_limits, autoscalex, autoscaley = self.limits[ax]
+            ax.dataLim.set(data_limits)
+            ax.set_xlim(xlim)
+            ax.set_ylim(ylim)
+            ax.set_autoscalex_on(autoscalex)
+            ax.set_autoscaley_on(autoscaley)
+            for loc, title in self.titles[ax]:
+                ax.set_title(title, loc=loc)
+
+
+class FigureTemplateCache():
+    """
+    Keeps the base map figures from .states in memory so a render doesn't have
+    to rebuild a whole Cartopy figure. A figure is checked out for
+    the length of one render and put back once everything drawn on it has been
+    removed, and the least recently used are dropped past size figures
+    """
+
+    def __init__(self, size):
+        self._size = size
+        self._templates = OrderedDict()
+        self._lock = Lock()
+
+    def _load_raster(self, name):
+        # Static layers pre-rasterized by scripts/_generate_base_image.py, one image
+        # is far cheaper for Agg to draw than every county, road and river
+        with open(f".states/{name}.georef.json", "r") as f:
+            georef = json.load(f)
+        fig, ax = plt.subplots(figsize=(12, 12), subplot_kw=dict(projection=ccrs.PlateCarree()))
+        # plt.imread would give float32, four times the memory of the 8 bit RGBA in the file
+        with Image.open(f".states/{name}.png") as image:
+            background = np.asarray(image.convert('RGBA'))
+        ax.imshow(background, origin='upper', extent=georef['extent'],
+                  transform=ccrs.PlateCarree(), zorder=georef['zorder'])
+        ax.set_extent(georef['bbox'])
+        ax.grid(False)
+        return fig
+
+    def _load(self, name):
+        if os.path.exists(f".states/{name}.georef.json"):
+            fig = self._load_raster(name)
+        else:
+            with open(f".states/{name}.pickle", "rb") as f:
+                fig = pickle.load(f)
+        # pyplot would keep the figure alive after it is evicted. It still renders
+        # through its Agg canvas once closed
+        plt.close(fig)
+        return fig, _Snapshot(fig)
+
+    @contextmanager
+    def figure(self, name):
+        with self._lock:
+            # Renders of the same state at the same time each get their own figure
+            template = self._templates.pop(name, None)
+        if template is None:
+            template = self._load(name)
+        try:
+            yield template[0]
+        finally:
+            self._release(name, template)
+
+    def _release(self, name, template):
+        fig, snapshot = template
+        try:
+            snapshot.restore(fig)
+        except Exception as e:
+            # Not worth keeping a figure that might still have another render on it
+            print(f"Dropping {name} base map: {e}")
+            return
+        with self._lock:
+            self._templates[name] = template
+            self._templates.move_to_end(name)
+            while len(self._templates) > self._size:
+                self._templates.popitem(last=False)
@@ -0,0 +1,69 @@
+import hashlib
+from threading import Lock
+
+from .config import get_config
+
+import boto3
+from botocore.client import Config
+from botocore.exceptions import ClientError
+
+# Presigned URLs can't be valid for longer than 7 days with SigV4, and they also
+# stop working when the credentials that signed them expire. On ECS those are the
+# task role's temporary credentials, which only last a few hours, so old messages
+# lose their maps unless s3.image_base_url serves the images instead
+PRESIGNED_URL_EXPIRATION = 7 * 24 * 60 * 60
+
+_stored_keys = set()
+_stored_keys_lock = Lock()
+_s3_client = None
+_s3_client_lock = Lock()
+
+
+def get_s3_client():
+    # boto3.client() itself isn't thread-safe, but the client it returns is, so
+    # one is created for the process and shared by every delivery thread.
+    # s3.endpoint_url points boto3 at a local S3 stand-in such as MinIO
+    global _s3_client
+    with _s3_client_lock:
+        if _s3_client is None:
+            _s3_client = boto3.client(
+                's3',
+                endpoint_url=get_config().get('s3', 'endpoint_url') or None,
+                config=Config(signature_version='s3v4'),
+            )
+        return _s3_client
+
+
+def _image_url(s3, key):
+    base_url = get_config().get('s3', 'image_base_url')
+    if base_url:
+        return base_url.rstrip('/') + '/' + key
+    return s3.generate_presigned_url(
+        'get_object',
+        Params={'Bucket': get_config().get('s3', 'bucket'), 'Key': key},
+        ExpiresIn=PRESIGNED_URL_EXPIRATION,
+    )
+
+
+def store_image(image):
+    # Images are stored under the hash of their content, so the same map or
+    # outlook is only ever uploaded once no matter how many workspaces get it
+    key = get_config().get('s3', 'image_prefix') + hashlib.sha256(image).hexdigest() + '.png'
+    s3 = get_s3_client()
+    with _stored_keys_lock:
+        stored = key in _stored_keys
+    if not stored:
+        try:
+            s3.head_object(Bucket=get_config().get('s3', 'bucket'), Key=key)
+        except ClientError as e:
+            if e.response['Error']['Code'] not in ['404', 'NoSuchKey', 'NotFound']:
+                raise
+            s3.put_object(
+                Bucket=get_config().get('s3', 'bucket'),
+                Key=key,
+                Body=image,
+                ContentType='image/png',
+            )
+        with _stored_keys_lock:
+            _stored_keys.add(key)
+    return _image_url(s3, key)
@@ -0,0 +1,186 @@
+from datetime import timedelta
+import math
+import sys
+from threading import Event, Lock, Thread
+import time
+import traceback
+import uuid
+
+from .config import get_config
+from .orm import Installation, WatcherLease
+
+from pynamodb.exceptions import DeleteError, PutError
+
+NODE_PREFIX = 'node#'
+
+
+class LeaseManager():
+    """
+    Shares the subscribed states between watcher processes. Each process
+    heartbeats a node record, takes leases on roughly its fair share of states
+    and hands states back when more nodes join. Leases of a dead node expire
+    after ttl seconds and are picked up by the remaining nodes.
+    """
+
+    def __init__(self, on_acquire, on_release):
+        self.node_id = str(uuid.uuid4())
+        self._on_acquire = on_acquire
+        self._on_release = on_release
+        self._ttl = get_config().get('leases', 'ttl')
+        self._resync_interval = get_config().get('leases', 'resync_interval')
+        self._lock = Lock()
+        # States every node knows about from the installations table
+        self._shared_states = set()
+        # States subscribed on this node since the last resync
+        self._local_states = set()
+        self._held = set()
+        # States whose lease is being written, add_state and the heartbeat can both try at once
+        self._acquiring = set()
+        self._last_resync = 0
+        self._stop_event = Event()
+        self._thread = Thread(target=self._heartbeat_loop)
+
+    def add_state(self, state):
+        with self._lock:
+            if state in self._shared_states:
+                return
+            self._local_states.add(state)
+        # Don't wait for the next heartbeat to start watching a new subscription
+        if not self._stop_event.is_set():
+            self._acquire(state)
+
+    def start(self):
+        self._thread.start()
+
+    def _heartbeat_loop(self):
+        while not self._stop_event.is_set():
+            try:
+                self._rebalance()
+            except Exception as e:
+                print(e)
+                traceback.print_exception(*sys.exc_info())
+            self._stop_event.wait(self._ttl / 3)
+
+    def _resync(self):
+        if time.time() - self._last_resync < self._resync_interval:
+            return
+        self._last_resync = time.time()
+        states = set()
+        for installation in Installation.bot_started_index.query(True):
+            states.add(installation.state)
+        with self._lock:
+            self._shared_states = states
+            self._local_states -= states
+
+    def _live_nodes(self):
+        WatcherLease(
+            NODE_PREFIX + self.node_id,
+            owner=self.node_id,
+            expires_at=time.time() + self._ttl,
+            cleanup_at=timedelta(seconds=self._ttl * 10),
+        ).save()
+        nodes = set()
+        for lease in WatcherLease.scan(WatcherLease.state.startswith(NODE_PREFIX) & (WatcherLease.expires_at > time.time())):
+            nodes.add(lease.owner)
+        nodes.add(self.node_id)
+        return nodes
+
+    def _save_lease(self, state):
+        now = time.time()
+        try:
+            WatcherLease(
+                state,
+                owner=self.node_id,
+                expires_at=now + self._ttl,
+                cleanup_at=timedelta(seconds=self._ttl * 10),
+            ).save(condition=(
+                WatcherLease.state.does_not_exist() |
+                (WatcherLease.expires_at < now) |
+                (WatcherLease.owner == self.node_id)
+            ))
+            return True
+        except PutError as e:
+            if e.cause_response_code == 'ConditionalCheckFailedException':
+                return False
+            raise
+
+    def _acquire(self, state):
+        with self._lock:
+            if state in self._held:
+                return True
+            if state in self._acquiring:
+                return False
+            self._acquiring.add(state)
+        try:
+            if not self._save_lease(state):
+                return False
+            print(f"Acquired lease for {state}")
+            with self._lock:
+                self._held.add(state)
+        finally:
+            with self._lock:
+                self._acquiring.discard(state)
+        self._on_acquire(state)
+        return True
+
+    def _release(self, state, delete=True):
+        with self._lock:
+            if state not in self._held:
+                return
+            self._held.discard(state)
+        print(f"Releasing lease for {state}")
+        self._on_release(state)
+        if delete:
+            try:
+                WatcherLease(state).delete(condition=WatcherLease.owner == self.node_id)
+            except DeleteError as e:
+                if e.cause_response_code != 'ConditionalCheckFailedException':
+                    raise
+
+    def _rebalance(self):
+        self._resync()
+        nodes = self._live_nodes()
+        with self._lock:
+            shared_states = sorted(self._shared_states)
+            local_states = sorted(self._local_states)
+            held = sorted(self._held)
+        target = math.ceil(len(shared_states) / len(nodes))
+
+        # Renew what we hold, anything we fail to renew was taken over after we missed heartbeats
+        for state in held:
+            if state not in shared_states and state not in local_states:
+                # Nobody is subscribed to this state anymore
+                self._release(state)
+            elif not self._save_lease(state):
+                print(f"Lost lease for {state}")
+                self._release(state, delete=False)
+        with self._lock:
+            held_shared = sorted(self._held & set(shared_states))
+
+        # Hand back one state per heartbeat when we have more than our share so
+        # new nodes fill up gradually instead of every state moving at once
+        if len(held_shared) > target:
+            self._release(held_shared[-1])
+        else:
+            # Take free states up to our share
+            for state in shared_states:
+                if len(held_shared) >= target:
+                    break
+                if state not in held_shared and self._acquire(state):
+                    held_shared.append(state)
+        # States only this node knows about are always taken since no other node would ever pick them up
+        for state in local_states:
+            self._acquire(state)
+
+    def stop(self):
+        self._stop_event.set()
+        if self._thread.is_alive():
+            self._thread.join()
+        with self._lock:
+            held = list(self._held)
+        for state in held:
+            self._release(state)
+        try:
+            WatcherLease(NODE_PREFIX + self.node_id).delete()
+        except DeleteError:
+            traceback.print_exception(*sys.exc_info())
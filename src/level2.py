@@ -0,0 +1,92 @@
+import bz2
+import io
+import struct
+
+from .config import get_config
+
+import boto3
+import botocore
+from botocore.client import Config
+from metpy.io import Level2File
+
+# Archive II volume header, "AR2V0006." followed by the volume number, date, time and ICAO
+VOLUME_HEADER_SIZE = 24
+# Every message starts with 12 bytes left over from the legacy CTM header, then its own header
+CTM_HEADER_SIZE = 12
+# Messages other than 31 are padded out to a fixed size
+FIXED_MESSAGE_SIZE = 2432
+# Offset of the radial status in a message 31 data header
+RADIAL_STATUS_OFFSET = 21
+END_ELEVATION = 2
+END_VOLUME = 4
+
+
+def _ends_first_elevation(record):
+    # True once a decompressed LDM record holds the radial that ends the first sweep
+    offset = 0
+    while offset + CTM_HEADER_SIZE + 16 <= len(record):
+        size_hw, _, msg_type = struct.unpack_from('>HBB', record, offset + CTM_HEADER_SIZE)
+        if msg_type == 31:
+            status = record[offset + CTM_HEADER_SIZE + 16 + RADIAL_STATUS_OFFSET]
+            if status in (END_ELEVATION, END_VOLUME):
+                return True
+            offset += CTM_HEADER_SIZE + size_hw * 2
+        else:
+            offset += FIXED_MESSAGE_SIZE
+        if size_hw == 0:
+            break
+    return False
+
+
+class _RangedReader():
+    """
+    Reads an S3 object from the start with ranged GETs of chunk_size bytes,
+    fetching the next range only when the parser runs past what it has
+    """
+
+    def __init__(self, s3, bucket, key, size, chunk_size):
+        self._s3 = s3
+        self._bucket = bucket
+        self._key = key
+        self._size = size
+        self._chunk_size = chunk_size
+        self.data = bytearray()
+
+    def ensure(self, end):
+        # Makes sure bytes up to end have been fetched, returns False past the end of the object
+        if end > self._size:
+            return False
+        while len(self.data) < end:
+            start = len(self.data)
+            stop = min(max(end, start + self._chunk_size), self._size) - 1
+            response = self._s3.get_object(Bucket=self._bucket, Key=self._key, Range=f'bytes={start}-{stop}')
+            self.data += response['Body'].read()
+        return True
+
+
+def read_lowest_sweep(obj):
+    """
+    Returns a Level2File of the first sweep of the Level II volume in obj, an
+    object summary from noaa-nexrad-level2. Only the LDM records up to the end
+    of that sweep are downloaded and decompressed, the rest of the volume is
+    never fetched
+    """
+    s3 = boto3.client('s3', config=Config(signature_version=botocore.UNSIGNED))
+    reader = _RangedReader(s3, obj.bucket_name, obj.key, obj.size, get_config().get('maps', 'level2_chunk_size'))
+    try:
+        offset = VOLUME_HEADER_SIZE
+        # The first record is metadata, radials start in the second
+        while reader.ensure(offset + 4):
+            # The last record of a volume has a negative size
+            size = abs(struct.unpack_from('>l', reader.data, offset)[0])
+            if not reader.ensure(offset + 4 + size):
+                break
+            record = bz2.decompress(reader.data[offset + 4:offset + 4 + size])
+            offset += 4 + size
+            if _ends_first_elevation(record):
+                break
+        return Level2File(io.BytesIO(bytes(reader.data[:offset])))
+    except (OSError, ValueError, struct.error, IndexError) as e:
+        # Not the layout we expect, so let MetPy read the whole volume
+        print(f"Falling back to the full Level II volume for {obj.key}: {e}")
+        return Level2File(obj.get()['Body'])
@@ -1,19 +1,51 @@
 import sys
 import traceback
 
-from .api import get_wx_watcher_manager
+from .alert import replay_outbox
+from .api import WXWatcher, get_wx_watcher_manager
+from .channels import get_channel_directory
+from .config import get_config
+from .control import ControlServer
+from .metrics import MetricsLogger
+from .outbox import OutboxWorker
+from .subscribers import get_subscriber_directory
+
+_control_server = ControlServer()
+_outbox_worker = OutboxWorker(replay_outbox, get_config().get('outbox', 'drain_interval'))
+_metrics_logger = MetricsLogger(get_config().get('metrics', 'log_interval'))
+
+
+def _subscribe(manager, message):
+    if 'team_id' in message:
+        get_subscriber_directory().update(message['team_id'], state=message['state'])
+    manager.add_and_start_watcher(WXWatcher(message['state']))
 
 
 def main():
-    get_wx_watcher_manager()
+    manager = get_wx_watcher_manager()
+    # Subscriptions made through /alert in the web workers arrive here
+    _control_server.register('subscribe', lambda message: _subscribe(manager, message))
+    _control_server.register('refresh_subscriber', lambda message: get_subscriber_directory().refresh(message['team_id']))
+    _control_server.register('invalidate_channels', lambda message: get_channel_directory().invalidate(message['team_id']))
+    _control_server.start()
+    # Deliveries left over from before a restart are replayed right away
+    _outbox_worker.start()
+    _metrics_logger.start()
+
+
+def stop():
+    _control_server.stop()
+    _outbox_worker.stop()
+    get_wx_watcher_manager().stop()
+    _metrics_logger.stop()
 
 
 if __name__ == '__main__':
     try:
         main()
     except KeyboardInterrupt:
-        get_wx_watcher_manager().stop()
+        stop()
     except Exception as e:
-        get_wx_watcher_manager().stop()
+        stop()
         print(e)
         traceback.print_exception(*sys.exc_info())
@@ -1,9 +1,13 @@
 import datetime
-import io
+import functools
+import json
 import pickle
 import re
 
 from .config import get_config
+from .figures import figure_to_png, get_figure_cache
+from .level2 import read_lowest_sweep
+from .radar_sites import get_radar_sites
 
 from adjustText import adjust_text
 from awips.dataaccess import DataAccessLayer
@@ -15,7 +19,7 @@ import matplotlib.pyplot as plt
 import matplotlib
 import metpy
 from metpy.units import units
-from metpy.io import Level2File
+import shapely.wkb
 from shapely.ops import unary_union
 import numpy as np
 import requests
@@ -104,8 +108,8 @@ def plot_radar(fig, ax, station, state, envelope=None, add_legend=True):
             print("Error parsing timestamp from key")
             return
         timestamp = datetime.datetime.strptime(match.group(1), '%Y%m%d_%H%M%S')
-        f = Level2File(obj.get()['Body'])
-        plot_radar_from_file(state, f, timestamp)
+        f = read_lowest_sweep(obj)
+        plot_radar_from_file(fig, ax, f, timestamp, add_legend=add_legend)
         return
 
     if availableLevels:
@@ -146,7 +150,18 @@ def get_boundaries_from_polygon(poly):
     return bbox, envelope
 
 
+@functools.lru_cache(maxsize=None)
 def get_boundaries(state):
+    # Precomputed with the base images, EDEX is only asked when they are missing
+    try:
+        with open(f".states/{state}.boundary.json", "r") as f:
+            boundary = json.load(f)
+    except FileNotFoundError:
+        return _get_boundaries_from_edex(state)
+    return boundary['bbox'], shapely.wkb.loads(boundary['envelope'], hex=True)
+
+
+def _get_boundaries_from_edex(state):
     request = DataAccessLayer.newDataRequest('maps')
     request.addIdentifier('table', 'mapdata.county')
     request.setLocationNames(state)
@@ -178,6 +193,15 @@ def get_closest_station(poly):
     # Get the center of the polygon
     center = poly.centroid
 
+    radar_sites = get_radar_sites()
+    if radar_sites is not None:
+        station = radar_sites.closest(center)
+        if station is not None:
+            return station.lower()
+    if not get_config().get('maps', 'radar_points_fallback'):
+        print("Error getting station")
+        return
+
     response = requests.get(
                 'https://api.weather.gov/points/{},{}'.format(center.y, center.x),
                 headers={
@@ -197,19 +221,12 @@ def get_closest_station(poly):
 
 def plot_alert_on_state(alert):
     _, envelope = get_boundaries(alert.state)
-    with open(f".states/{alert.state}.pickle", "rb") as f:
-        fig = pickle.load(f)
-    ax = fig.axes[0]
-    if alert.should_show_radar():
-        plot_radar(fig, ax, get_closest_station(alert.polygon), alert.state, envelope=envelope)
-    alert.plot(ax)
-    buf = io.BytesIO()
-    plt.savefig(buf, format='png', bbox_inches='tight')
-    buf.seek(0)
-    image = buf.getvalue()
-    buf.close()
-    plt.close()
-    return image
+    with get_figure_cache().figure(alert.state) as fig:
+        ax = fig.axes[0]
+        if alert.should_show_radar():
+            plot_radar(fig, ax, get_closest_station(alert.polygon), alert.state, envelope=envelope)
+        alert.plot(ax)
+        return figure_to_png(fig)
 
 
 def get_latest_radar_scan(station):
@@ -240,22 +257,13 @@ def plot_radar_lvl2_from_station(state, station):
         print("Error parsing timestamp from key")
         return
     timestamp = datetime.datetime.strptime(match.group(1), '%Y%m%d_%H%M%S')
-    f = Level2File(obj.get()['Body'])
-    plot_radar_from_file(state, f, timestamp)
-    buf = io.BytesIO()
-    plt.savefig(buf, format='png', bbox_inches='tight')
-    buf.seek(0)
-    image = buf.getvalue()
-    buf.close()
-    plt.close()
-    return image
-
-
-def plot_radar_from_file(state, f, timestamp, add_legend=True):
-    with open(f".states/{state}.pickle", "rb") as pf:
-        fig = pickle.load(pf)
-    ax = fig.axes[0]
+    f = read_lowest_sweep(obj)
+    with get_figure_cache().figure(state) as fig:
+        plot_radar_from_file(fig, fig.axes[0], f, timestamp)
+        return figure_to_png(fig)
+
 
+def plot_radar_from_file(fig, ax, f, timestamp, add_legend=True):
     sweep = 0
     # First item in ray is header, which has azimuth angle
     az = np.array([ray[0].az_angle for ray in f.sweeps[sweep]])
@@ -295,42 +303,27 @@ def plot_radar_from_file(state, f, timestamp, add_legend=True):
 
 def plot_radar_from_station(state, station):
     _, envelope = get_boundaries(state)
-    with open(f".states/{state}.pickle", "rb") as f:
-        fig = pickle.load(f)
-    ax = fig.axes[0]
-    plot_radar(fig, ax, station, state, envelope=envelope)
-    buf = io.BytesIO()
-    plt.savefig(buf, format='png', bbox_inches='tight')
-    buf.seek(0)
-    image = buf.getvalue()
-    buf.close()
-    plt.close()
-    return image
+    with get_figure_cache().figure(state) as fig:
+        plot_radar(fig, fig.axes[0], station, state, envelope=envelope)
+        return figure_to_png(fig)
 
 
 def plot_all_state_alerts(state):
     alerts = _get_alerts(state)
     _, envelope = get_boundaries(state)
-    with open(f".states/{state}.pickle", "rb") as f:
-        fig = pickle.load(f)
-    ax = fig.axes[0]
-    seen_stations = []
-    for alert in alerts:
-        if alert.should_show_radar():
-            closest_station = get_closest_station(alert.polygon)
-            if closest_station not in seen_stations:
-                seen_stations.append(closest_station)
-                plot_radar(fig, ax, closest_station, state, envelope=envelope, add_legend=len(seen_stations) == 1)
-            else:
-                print("Skipping duplicate station: ", closest_station)
-        alert.plot(ax)
-    buf = io.BytesIO()
-    plt.savefig(buf, format='png', bbox_inches='tight')
-    buf.seek(0)
-    image = buf.getvalue()
-    buf.close()
-    plt.close()
-    return image
+    with get_figure_cache().figure(state) as fig:
+        ax = fig.axes[0]
+        seen_stations = []
+        for alert in alerts:
+            if alert.should_show_radar():
+                closest_station = get_closest_station(alert.polygon)
+                if closest_station not in seen_stations:
+                    seen_stations.append(closest_station)
+                    plot_radar(fig, ax, closest_station, state, envelope=envelope, add_legend=len(seen_stations) == 1)
+                else:
+                    print("Skipping duplicate station: ", closest_station)
+            alert.plot(ax)
+        return figure_to_png(fig)
 
 
 def plot_all_state_alerts_one_at_a_time(state):
@@ -352,19 +345,12 @@ def plot_all_state_alerts_one_at_a_time(state):
 
 
 def plot_alert_area(alert):
-    with open(f".states/{alert.state}.pickle", "rb") as f:
-        fig = pickle.load(f)
-    ax = fig.axes[0]
     _, alert_envelope = get_boundaries_from_polygon(alert.polygon)
-    if alert.should_show_radar():
-        plot_radar(fig, ax, get_closest_station(alert.polygon), alert.state, envelope=alert_envelope)
-    buf = io.BytesIO()
-    plt.savefig(buf, format='png', bbox_inches='tight')
-    buf.seek(0)
-    image = buf.getvalue()
-    buf.close()
-    plt.close()
-    return image
+    with get_figure_cache().figure(alert.state) as fig:
+        ax = fig.axes[0]
+        if alert.should_show_radar():
+            plot_radar(fig, ax, get_closest_station(alert.polygon), alert.state, envelope=alert_envelope)
+        return figure_to_png(fig)
 
 
 def plot_cities(ax, envelope=None, adjust=False):
@@ -0,0 +1,64 @@
+import sys
+from threading import Event, Lock, Thread
+import traceback
+
+_lock = Lock()
+_counters = {}
+_timings = {}
+
+
+def increment(name, value=1):
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + value
+
+
+def observe(name, seconds):
+    # Keeps the count, total and worst case of a timing, e.g. delivery latency
+    with _lock:
+        count, total, worst = _timings.get(name, (0, 0, 0))
+        _timings[name] = (count + 1, total + seconds, max(worst, seconds))
+
+
+def get_metrics():
+    with _lock:
+        metrics = dict(_counters)
+        for name, (count, total, worst) in _timings.items():
+            metrics[name + '_count'] = count
+            metrics[name + '_avg'] = total / count
+            metrics[name + '_max'] = worst
+        return metrics
+
+
+def log_metrics():
+    metrics = get_metrics()
+    if metrics:
+        print("Metrics: " + ", ".join(f"{name}={value:g}" for name, value in sorted(metrics.items())))
+
+
+class MetricsLogger():
+    """
+    Prints the metrics every interval seconds on its own thread, long-running
+    processes have no other way to report them
+    """
+
+    def __init__(self, interval):
+        self._interval = interval
+        self._stop_event = Event()
+        self._thread = Thread(target=self._log_loop, daemon=True)
+
+    def _log_loop(self):
+        while not self._stop_event.wait(self._interval):
+            try:
+                log_metrics()
+            except Exception as e:
+                print(e)
+                traceback.print_exception(*sys.exc_info())
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop_event.set()
+        if self._thread.is_alive():
+            self._thread.join()
+        log_metrics()
@@ -1,6 +1,6 @@
 from .config import get_config
 
-from pynamodb.attributes import UnicodeAttribute, UTCDateTimeAttribute, Attribute, NUMBER
+from pynamodb.attributes import UnicodeAttribute, UTCDateTimeAttribute, TTLAttribute, NumberAttribute, Attribute, NUMBER
 from pynamodb.indexes import GlobalSecondaryIndex, AllProjection
 from pynamodb.models import Model
 
@@ -29,6 +29,7 @@ class InstallationStateIndex(GlobalSecondaryIndex):
         index_name = 'state-index'
         projection = AllProjection()
         region = get_config().get('dynamodb', 'region')
+        host = get_config().get('dynamodb', 'host') or None
 
     state = UnicodeAttribute(null=True, hash_key=True)
 
@@ -38,6 +39,7 @@ class InstallationBotStartedIndex(GlobalSecondaryIndex):
         index_name = 'bot_started-index'
         projection = AllProjection()
         region = get_config().get('dynamodb', 'region')
+        host = get_config().get('dynamodb', 'host') or None
 
     bot_started = BooleanAsNumberAttribute(null=False, hash_key=True)
 
@@ -46,6 +48,7 @@ class Installation(Model):
     class Meta:
         table_name = get_config().get('dynamodb', 'installations_table')
         region = get_config().get('dynamodb', 'region')
+        host = get_config().get('dynamodb', 'host') or None
 
     team_id = UnicodeAttribute(hash_key=True, null=False)
     bot_token = UnicodeAttribute(null=False)
@@ -61,6 +64,7 @@ class ActiveAlertsStateIndex(GlobalSecondaryIndex):
         index_name = 'state-index'
         projection = AllProjection()
         region = get_config().get('dynamodb', 'region')
+        host = get_config().get('dynamodb', 'host') or None
 
     state = UnicodeAttribute(null=False, hash_key=True)
 
@@ -69,7 +73,27 @@ class ActiveAlerts(Model):
     class Meta:
         table_name = get_config().get('dynamodb', 'active_alerts_table')
         region = get_config().get('dynamodb', 'region')
+        host = get_config().get('dynamodb', 'host') or None
 
     id = UnicodeAttribute(hash_key=True, null=False)
     state_index = ActiveAlertsStateIndex()
     state = UnicodeAttribute(null=False)
+    # DynamoDB deletes the item on its own once the alert has ended
+    expires_at = TTLAttribute(null=True)
+
+
+class WatcherLease(Model):
+    """
+    A lease on polling one state, or a node heartbeat when state starts with "node#"
+    """
+
+    class Meta:
+        table_name = get_config().get('dynamodb', 'lease_table')
+        region = get_config().get('dynamodb', 'region')
+        host = get_config().get('dynamodb', 'host') or None
+
+    state = UnicodeAttribute(hash_key=True, null=False)
+    owner = UnicodeAttribute(null=False)
+    expires_at = NumberAttribute(null=False)  # Unix timestamp
+    # Lets DynamoDB clean up heartbeats and leases of nodes that are long gone
+    cleanup_at = TTLAttribute(null=True)
@@ -0,0 +1,294 @@
+import json
+import sqlite3
+import sys
+from threading import Event, Lock, Thread
+import time
+import traceback
+
+from .config import get_config
+from .metrics import increment
+
+PENDING = 'pending'
+# The message is in the channel but its map hasn't been uploaded yet
+POSTED = 'posted'
+DONE = 'done'
+FAILED = 'failed'
+
+_outbox = None
+
+
+def get_outbox():
+    global _outbox
+    if _outbox is None:
+        _outbox = Outbox(
+            get_config().get('outbox', 'path'),
+            get_config().get('outbox', 'max_attempts'),
+            get_config().get('outbox', 'retry_interval'),
+            get_config().get('outbox', 'claim_timeout'),
+        )
+    return _outbox
+
+
+def delivery_key(alert_id, team_id, channel_id):
+    # Idempotency key of one alert in one channel, a team only ever watches one state
+    return f"{alert_id}/{team_id}/{channel_id}"
+
+
+class Outbox():
+    """
+    Records new alerts and every channel they have to reach in SQLite on local
+    disk before anything is sent, so a crash or a failed channel is retried
+    instead of dropped. Rows are claimed for claim_timeout seconds while they
+    are delivered, after which a replay picks up whatever wasn't finished.
+    """
+
+    def __init__(self, path, max_attempts, retry_interval, claim_timeout):
+        self._max_attempts = max_attempts
+        self._retry_interval = retry_interval
+        self._claim_timeout = claim_timeout
+        self._lock = Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        # A power loss can lose the last transactions in WAL mode, but not corrupt the database
+        self._db.execute('PRAGMA synchronous=NORMAL')
+        self._db.executescript('''
+            CREATE TABLE IF NOT EXISTS alerts (
+                id TEXT NOT NULL,
+                state TEXT NOT NULL,
+                feature TEXT NOT NULL,
+                expanded INTEGER NOT NULL DEFAULT 0,
+                -- Replays that claimed the alert without expanding it
+                attempts INTEGER NOT NULL DEFAULT 0,
+                claimed_until REAL NOT NULL,
+                created REAL NOT NULL,
+                PRIMARY KEY (id, state)
+            );
+            CREATE TABLE IF NOT EXISTS deliveries (
+                key TEXT PRIMARY KEY,
+                alert_id TEXT NOT NULL,
+                state TEXT NOT NULL,
+                team_id TEXT NOT NULL,
+                channel_id TEXT NOT NULL,
+                status TEXT NOT NULL,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                next_attempt REAL NOT NULL,
+                last_error TEXT,
+                -- Slack ts of the message this delivery posted, or will edit for an update
+                ts TEXT,
+                created REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS deliveries_due ON deliveries (status, next_attempt);
+            CREATE INDEX IF NOT EXISTS deliveries_alert ON deliveries (alert_id, state);
+        ''')
+        if 'ts' not in [column[1] for column in self._db.execute('PRAGMA table_info(deliveries)')]:
+            self._db.execute('ALTER TABLE deliveries ADD COLUMN ts TEXT')
+        if 'attempts' not in [column[1] for column in self._db.execute('PRAGMA table_info(alerts)')]:
+            self._db.execute('ALTER TABLE alerts ADD COLUMN attempts INTEGER NOT NULL DEFAULT 0')
+
+    def _transaction(self, func, *args):
+        with self._lock:
+            self._db.execute('BEGIN IMMEDIATE')
+            try:
+                result = func(*args)
+            except BaseException:
+                self._db.execute('ROLLBACK')
+                raise
+            self._db.execute('COMMIT')
+            return result
+
+    def add_alerts(self, state, features):
+        # Called before the alerts are marked as seen in ActiveAlerts. They start
+        # out claimed since the watcher is about to send them itself
+        now = time.time()
+        rows = [
+            (feature['properties']['id'], state, json.dumps(feature), now + self._claim_timeout, now)
+            for feature in features
+        ]
+        self._transaction(lambda: self._db.executemany(
+            'INSERT OR IGNORE INTO alerts (id, state, feature, claimed_until, created) VALUES (?, ?, ?, ?, ?)',
+            rows,
+        ))
+
+    def claim_alerts(self):
+        # Alerts that were never expanded into deliveries, e.g. after a crash. One
+        # that still isn't expanded after max_attempts replays is given up on
+        def claim():
+            now = time.time()
+            rows = self._db.execute(
+                'SELECT id, state, feature, attempts FROM alerts WHERE expanded = 0 AND claimed_until <= ?',
+                (now,),
+            ).fetchall()
+            claimed = [row for row in rows if row[3] < self._max_attempts]
+            expired = [row for row in rows if row[3] >= self._max_attempts]
+            for alert_id, _, _, attempts in expired:
+                print(f"Giving up on alert {alert_id} after {attempts} attempts")
+            self._db.executemany(
+                'UPDATE alerts SET expanded = 1 WHERE id = ? AND state = ?',
+                [(alert_id, state) for alert_id, state, _, _ in expired],
+            )
+            self._db.executemany(
+                'UPDATE alerts SET claimed_until = ?, attempts = attempts + 1 WHERE id = ? AND state = ?',
+                [(now + self._claim_timeout, alert_id, state) for alert_id, state, _, _ in claimed],
+            )
+            return [(alert_id, state, json.loads(feature)) for alert_id, state, feature, _ in claimed], len(expired)
+        rows, expired = self._transaction(claim)
+        if expired:
+            increment('outbox_alerts_failed', expired)
+        return rows
+
+    def discard_alert(self, alert_id, state):
+        # An alert that can't be parsed would otherwise be claimed again on every replay
+        with self._lock:
+            self._db.execute('UPDATE alerts SET expanded = 1 WHERE id = ? AND state = ?', (alert_id, state))
+        increment('outbox_discarded')
+
+    def get_feature(self, alert_id, state):
+        with self._lock:
+            row = self._db.execute(
+                'SELECT feature FROM alerts WHERE id = ? AND state = ?', (alert_id, state)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def _posted_messages(self, references, state):
+        # The newest message in each channel for the alerts in references, which
+        # an Update or Cancel edits instead of posting again
+        messages = {}
+        if not references:
+            return messages
+        rows = self._db.execute(
+            'SELECT team_id, channel_id, ts FROM deliveries '
+            f'WHERE alert_id IN ({", ".join("?" * len(references))}) AND state = ? AND ts IS NOT NULL '
+            'ORDER BY created',
+            tuple(references) + (state,),
+        ).fetchall()
+        for team_id, channel_id, ts in rows:
+            messages[(team_id, channel_id)] = ts
+        return messages
+
+    def add_deliveries(self, alert_id, state, targets, references=()):
+        # Records every (team_id, channel_id) the alert goes to and marks it expanded.
+        # Keys that already exist are left alone, so expanding twice sends nothing twice
+        def add():
+            now = time.time()
+            messages = self._posted_messages(references, state)
+            self._db.executemany(
+                'INSERT OR IGNORE INTO deliveries '
+                '(key, alert_id, state, team_id, channel_id, status, next_attempt, ts, created) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                [
+                    (
+                        delivery_key(alert_id, team_id, channel_id), alert_id, state, team_id, channel_id,
+                        PENDING, now, messages.get((team_id, channel_id)), now,
+                    )
+                    for team_id, channel_id in targets
+                ],
+            )
+            self._db.execute('UPDATE alerts SET expanded = 1 WHERE id = ? AND state = ?', (alert_id, state))
+        self._transaction(add)
+
+    def _claim_deliveries(self, where, params, limit):
+        now = time.time()
+        rows = self._db.execute(
+            'SELECT key, alert_id, state, team_id, channel_id, status, ts FROM deliveries '
+            f'WHERE status IN (?, ?) AND next_attempt <= ? AND {where} ORDER BY next_attempt LIMIT ?',
+            (PENDING, POSTED, now) + params + (limit,),
+        ).fetchall()
+        self._db.executemany(
+            'UPDATE deliveries SET next_attempt = ? WHERE key = ?',
+            [(now + self._claim_timeout, row[0]) for row in rows],
+        )
+        return rows
+
+    def claim_deliveries(self, alert_id, state):
+        return self._transaction(self._claim_deliveries, 'alert_id = ? AND state = ?', (alert_id, state), -1)
+
+    def claim_due_deliveries(self, limit=1000):
+        return self._transaction(self._claim_deliveries, '1', (), limit)
+
+    def extend_claims(self, keys):
+        # Delivering to a large workspace can outlast claim_timeout, so rows are
+        # claimed again right before they're sent instead of being replayed mid-delivery
+        until = time.time() + self._claim_timeout
+        with self._lock:
+            self._db.executemany(
+                'UPDATE deliveries SET next_attempt = ? WHERE key = ? AND status IN (?, ?)',
+                [(until, key, PENDING, POSTED) for key in keys],
+            )
+
+    def mark_posted(self, key, ts):
+        with self._lock:
+            self._db.execute('UPDATE deliveries SET status = ?, ts = ? WHERE key = ?', (POSTED, ts, key))
+
+    def complete(self, key, ts=None):
+        with self._lock:
+            self._db.execute('UPDATE deliveries SET status = ?, ts = COALESCE(?, ts) WHERE key = ?', (DONE, ts, key))
+        increment('outbox_delivered')
+
+    def retry(self, key, error):
+        # Backs off exponentially and gives up after max_attempts
+        def update():
+            attempts = self._db.execute('SELECT attempts FROM deliveries WHERE key = ?', (key,)).fetchone()[0] + 1
+            if attempts >= self._max_attempts:
+                print(f"Giving up on delivery {key} after {attempts} attempts: {error}")
+                self._db.execute(
+                    'UPDATE deliveries SET status = ?, attempts = ?, last_error = ? WHERE key = ?',
+                    (FAILED, attempts, str(error), key),
+                )
+                return False
+            self._db.execute(
+                'UPDATE deliveries SET attempts = ?, next_attempt = ?, last_error = ? WHERE key = ?',
+                (attempts, time.time() + self._retry_interval * 2 ** (attempts - 1), str(error), key),
+            )
+            return True
+        if self._transaction(update):
+            increment('outbox_retried')
+        else:
+            increment('outbox_failed')
+
+    def purge(self, retention):
+        # Drops finished alerts, keeping them for retention seconds so a late
+        # duplicate from the feed still finds its deliveries
+        def delete():
+            before = time.time() - retention
+            self._db.execute(
+                'DELETE FROM alerts WHERE created < ? AND expanded = 1 AND NOT EXISTS ('
+                'SELECT 1 FROM deliveries WHERE deliveries.alert_id = alerts.id '
+                'AND deliveries.state = alerts.state AND status IN (?, ?))',
+                (before, PENDING, POSTED),
+            )
+            self._db.execute(
+                'DELETE FROM deliveries WHERE created < ? AND status IN (?, ?)', (before, DONE, FAILED))
+        self._transaction(delete)
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+
+class OutboxWorker():
+    """
+    Calls drain every interval seconds on its own thread to replay whatever is
+    left in the outbox
+    """
+
+    def __init__(self, drain, interval):
+        self._drain = drain
+        self._interval = interval
+        self._stop_event = Event()
+        self._thread = Thread(target=self._drain_loop)
+
+    def _drain_loop(self):
+        while not self._stop_event.is_set():
+            try:
+                self._drain()
+            except Exception as e:
+                print(e)
+                traceback.print_exception(*sys.exc_info())
+            self._stop_event.wait(self._interval)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop_event.set()
+        if self._thread.is_alive():
+            self._thread.join()
@@ -0,0 +1,79 @@
+import json
+import math
+
+from .config import get_config
+
+import numpy as np
+from shapely.geometry import Point
+from shapely.ops import nearest_points
+from shapely.strtree import STRtree
+
+EARTH_RADIUS_KM = 6371
+KM_PER_DEGREE = 111.2
+
+_radar_sites = None
+
+
+def get_radar_sites():
+    # None if the site table wasn't generated with the base images
+    global _radar_sites
+    if _radar_sites is None:
+        try:
+            with open(get_config().get('maps', 'radar_sites'), 'r') as f:
+                _radar_sites = RadarSites(json.load(f))
+        except FileNotFoundError:
+            print("Radar site table not found")
+            return None
+    return _radar_sites
+
+
+def _unit_vectors(lats, lons):
+    lats = np.radians(lats)
+    lons = np.radians(lons)
+    return np.stack([np.cos(lats) * np.cos(lons), np.cos(lats) * np.sin(lons), np.sin(lats)], axis=-1)
+
+
+def _distance_km(a, b):
+    # Great circle distance between two shapely points in longitude and latitude
+    cos_angle = np.dot(_unit_vectors(a.y, a.x), _unit_vectors(b.y, b.x))
+    return EARTH_RADIUS_KM * math.acos(min(1.0, max(-1.0, cos_angle)))
+
+
+class RadarSites():
+    """
+    Answers which radar is closest to a point and which radars cover a polygon
+    from the site table made by scripts/generate_radar_sites.py. Sites are kept
+    as unit vectors so the closest one is a single dot product, and in an
+    STRtree for polygon queries
+    """
+
+    def __init__(self, sites):
+        self._sites = sites
+        self._vectors = _unit_vectors(
+            np.array([site['lat'] for site in sites]),
+            np.array([site['lon'] for site in sites]),
+        )
+        self._points = [Point(site['lon'], site['lat']) for site in sites]
+        self._tree = STRtree(self._points)
+
+    def closest(self, point, types=('WSR-88D',)):
+        # The largest dot product between unit vectors is the smallest great circle distance
+        similarity = self._vectors @ _unit_vectors(point.y, point.x)
+        for i in np.argsort(-similarity):
+            if self._sites[i]['type'] in types:
+                return self._sites[i]['id']
+        return None
+
+    def covering(self, poly, range_km=230, types=('WSR-88D',)):
+        # Longitude degrees shrink toward the poles, so search a box wide enough at
+        # the polygon's highest latitude and check the real distance afterwards
+        max_lat = min(max(abs(poly.bounds[1]), abs(poly.bounds[3])) + range_km / KM_PER_DEGREE, 89)
+        degrees = range_km / KM_PER_DEGREE / math.cos(math.radians(max_lat))
+        stations = []
+        for i in self._tree.query(poly.buffer(degrees)):
+            if self._sites[i]['type'] not in types:
+                continue
+            nearest, _ = nearest_points(poly, self._points[i])
+            if _distance_km(nearest, self._points[i]) <= range_km:
+                stations.append(self._sites[i]['id'])
+        return sorted(stations)
@@ -0,0 +1,30 @@
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing
+
+from .config import get_config
+
+_render_pool = None
+
+
+def _init_render_process(cache_size):
+    from .figures import set_figure_cache_size
+    set_figure_cache_size(cache_size)
+
+
+def get_render_pool():
+    global _render_pool
+    if _render_pool is None:
+        # Spawned rather than forked, the web worker has Bolt and HTTP client threads running
+        _render_pool = ProcessPoolExecutor(
+            max_workers=get_config().get('slack', 'render_workers'),
+            mp_context=multiprocessing.get_context('spawn'),
+            initializer=_init_render_process,
+            initargs=(get_config().get('maps', 'render_template_cache_size'),),
+        )
+    return _render_pool
+
+
+def render(func, *args, **kwargs):
+    # Matplotlib isn't thread safe and rendering holds the GIL, so images for
+    # slash commands are drawn in separate processes and only waited on here
+    return get_render_pool().submit(func, *args, **kwargs).result()
@@ -0,0 +1,71 @@
+import random
+
+from .config import get_config
+
+
+class NWSRequestError(Exception):
+    """
+    Raised when api.weather.gov rate limits us or has a server error
+    """
+
+    def __init__(self, status, retry_after=None):
+        super().__init__(f"api.weather.gov returned {status}")
+        self.status = status
+        self.retry_after = retry_after
+
+
+def parse_retry_after(value):
+    # Retry-After can also be an HTTP date, in which case we fall back to our own backoff
+    try:
+        return max(0, int(value))
+    except (TypeError, ValueError):
+        return None
+
+
+class PollScheduler():
+    """
+    Decides how long a watcher waits between polls. Polls are faster while
+    fast_poll_events are active, slower while the feed is empty, back off
+    exponentially after errors and are jittered so watchers don't line up
+    """
+
+    def __init__(self):
+        self._interval = get_config().get('watcher', 'interval')
+        self._min_interval = get_config().get('watcher', 'min_interval')
+        self._quiet_interval = get_config().get('watcher', 'quiet_interval')
+        self._max_backoff = get_config().get('watcher', 'max_backoff')
+        self._jitter = get_config().get('watcher', 'jitter')
+        self._fast_poll_events = set(get_config().get('watcher', 'fast_poll_events'))
+        self._current_interval = self._interval
+        self._failures = 0
+        self._retry_after = None
+
+    def first_delay(self):
+        # Spread the first poll of each watcher over a whole interval
+        return random.uniform(0, self._interval)
+
+    def record_alerts(self, features):
+        if any(feature['properties']['event'] in self._fast_poll_events for feature in features):
+            self._current_interval = self._min_interval
+        elif len(features) == 0:
+            self._current_interval = self._quiet_interval
+        else:
+            self._current_interval = self._interval
+
+    def record_success(self):
+        self._failures = 0
+        self._retry_after = None
+
+    def record_error(self, retry_after=None):
+        self._failures += 1
+        self._retry_after = retry_after
+
+    def next_delay(self, elapsed=0):
+        if self._failures > 0:
+            delay = min(self._max_backoff, self._interval * 2 ** (self._failures - 1))
+            if self._retry_after is not None:
+                delay = max(delay, self._retry_after)
+        else:
+            delay = self._current_interval
+        delay += delay * self._jitter * random.uniform(-1, 1)
+        return max(0, delay - elapsed)
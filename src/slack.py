@@ -2,19 +2,22 @@ import sys
 import time
 import traceback
 
+from .clients import get_client, get_web_client_pool
 from .config import get_config
+from .control import send_control_message
+from .images import get_s3_client
 from .orm import Installation
+from .render import render
+from .subscribers import get_subscriber_directory
 from .map import plot_radar_lvl2_from_station
 from .spc_common import _plot_spc_outlook
 
-import boto3
 from slack_bolt import App
 from slack_sdk.oauth import OAuthStateUtils
 from slack_bolt.oauth.oauth_settings import OAuthSettings
 from slack_sdk.oauth.installation_store.amazon_s3 import AmazonS3InstallationStore
 from slack_sdk.oauth.state_store.amazon_s3 import AmazonS3OAuthStateStore
 from slack_bolt.oauth.callback_options import CallbackOptions, SuccessArgs, FailureArgs
-from slack_sdk import WebClient
 from slack_sdk.errors import SlackApiError
 from slack_bolt import BoltResponse
 
@@ -24,6 +27,8 @@ def _success(args: SuccessArgs) -> BoltResponse:
     client = args.request.context.client
     try:
         existing_installation = Installation.get(installation.team_id)
+        # Don't keep sending with a client holding the old token
+        get_web_client_pool().refresh(installation.team_id, installation.bot_token)
         if existing_installation:
             existing_installation.update(actions=[
                 Installation.bot_token.set(installation.bot_token),
@@ -36,6 +41,8 @@ def _success(args: SuccessArgs) -> BoltResponse:
                 bot_token_expires_at=installation.bot_token_expires_at,
                 bot_started=False,
             ).save()
+        get_subscriber_directory().update(installation.team_id, bot_token=installation.bot_token)
+        send_control_message({'op': 'refresh_subscriber', 'team_id': installation.team_id})
         client.chat_postMessage(
             token=installation.bot_token,  # Use the token you just got from oauth.v2.access API response
             channel=installation.user_id,  # Only with chat.postMessage API, you can use user_id here
@@ -55,13 +62,13 @@ def _failure(args: FailureArgs) -> BoltResponse:
 
 
 _state_store = AmazonS3OAuthStateStore(
-    s3_client=boto3.client("s3"),
+    s3_client=get_s3_client(),
     bucket_name=get_config().get("s3", "bucket"),
     expiration_seconds=OAuthStateUtils.default_expiration_seconds,
 )
 
 _installation_store = AmazonS3InstallationStore(
-    s3_client=boto3.client("s3"),
+    s3_client=get_s3_client(),
     bucket_name=get_config().get("s3", "bucket"),
     client_id=get_config().get("slack", "client_id"),
 )
@@ -92,6 +99,28 @@ def log_request(logger, body, next):
     return next()
 
 
+def _invalidate_channels(team_id):
+    # The watcher process owns the channel cache used for delivery
+    send_control_message({'op': 'invalidate_channels', 'team_id': team_id})
+
+
+@slack_app.event("member_joined_channel")
+def member_joined_channel(event, context):
+    if event['user'] == context.bot_user_id:
+        _invalidate_channels(context.team_id)
+
+
+@slack_app.event("member_left_channel")
+def member_left_channel(event, context):
+    if event['user'] == context.bot_user_id:
+        _invalidate_channels(context.team_id)
+
+
+@slack_app.event("channel_archive")
+def channel_archive(context):
+    _invalidate_channels(context.team_id)
+
+
 def is_state_valid(state):
     ret = True
     reason = ""
@@ -182,40 +211,36 @@ def start_command(ack, say, command):
         if not valid:
             say(reason)
             return
-        # Find the installation and update the bot_started flag and state
-        installation = None
-        res = Installation.query(command['team_id'])
-        if not res:
+        # Update the bot_started flag and state
+        if get_subscriber_directory().get(command['team_id']) is None:
             say("Installation not found.")
             return
-        for res_ in res:
-            installation = res_
-            break
-        installation.update(actions=[
+        Installation(command['team_id']).update(actions=[
             Installation.bot_started.set(True),
             Installation.state.set(state)
         ])
+        get_subscriber_directory().update(command['team_id'], state=state)
         say(f"Starting to watch for alerts in {state}...")
-        from .api import WXWatcher, get_wx_watcher_manager
-        get_wx_watcher_manager().add_and_start_watcher(WXWatcher(state=state))
+        # The watcher process does the polling, web workers only tell it about the new state
+        send_control_message({'op': 'subscribe', 'team_id': command['team_id'], 'state': state})
     except Exception as e:
         print(f"Error posting message: {e}")
         traceback.print_exception(*sys.exc_info())
         say("Error occurred while processing `/alert " + command['text'] + "`")
 
 
-@slack_app.command("/radar")
-def radar_command(ack, say, command):
+def _ack_command(ack):
+    # Slash commands are acknowledged right away, the work is done by a lazy
+    # listener in the background so web workers stay free for other requests
     ack()
-    installation = None
-    res = Installation.query(command['team_id'])
-    if not res:
+
+
+def radar_command(say, command):
+    installation = get_subscriber_directory().get(command['team_id'])
+    if installation is None:
         say("Installation not found.")
         return
-    for res_ in res:
-        installation = res_
-        break
-    client = WebClient(token=installation.bot_token)
+    client = get_client(installation.team_id, installation.bot_token)
     try:
         if 'text' not in command:
             client.chat_postEphemeral(
@@ -237,7 +262,7 @@ def radar_command(ack, say, command):
         say(f"Fetching latest radar scan for {radar.upper()} in {state.upper()}. Please be patient, this could take a few seconds.")
         client.files_upload_v2(
             channel=command['channel_id'],
-            content=plot_radar_lvl2_from_station(state, radar),
+            content=render(plot_radar_lvl2_from_station, state, radar),
             title=f"{radar.upper()} in {state.upper()}",
             filename=f"{radar.upper()}-{str(time.time())}.png",
             initial_comment=f"Here's the radar for {radar.upper()} in {state.upper()}"
@@ -248,18 +273,12 @@ def radar_command(ack, say, command):
         say("Error occurred while processing `/radar " + command['text'] + "`")
 
 
-@slack_app.command("/spc")
-def spc_command(ack, say, command):
-    ack()
-    installation = None
-    res = Installation.query(command['team_id'])
-    if not res:
+def spc_command(say, command):
+    installation = get_subscriber_directory().get(command['team_id'])
+    if installation is None:
         say("Installation not found.")
         return
-    for res_ in res:
-        installation = res_
-        break
-    client = WebClient(token=installation.bot_token)
+    client = get_client(installation.team_id, installation.bot_token)
     try:
         if 'text' not in command:
             client.chat_postEphemeral(
@@ -320,7 +339,7 @@ def spc_command(ack, say, command):
             outlook_name = "Unknown"
         # Send the user a friendly acknowledgement message and mention that the SPC images could take a few seconds to download and generate
         say(f"Fetching latest SPC {outlook_name} Outlook for day {day}. Please be patient, this could take a few seconds.")
-        image = _plot_spc_outlook(day=day, type=outlook)
+        image = render(_plot_spc_outlook, day=day, type=outlook)
         if not image:
             client.chat_postEphemeral(
                 text="Error generating image",
@@ -337,3 +356,7 @@ def spc_command(ack, say, command):
         print(f"Error posting message: {e}")
         traceback.print_exception(*sys.exc_info())
         say("Error occurred while processing `/spc " + command['text'] + "`")
+
+
+slack_app.command("/radar")(ack=_ack_command, lazy=[radar_command])
+slack_app.command("/spc")(ack=_ack_command, lazy=[spc_command])
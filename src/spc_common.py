@@ -1,20 +1,24 @@
 from datetime import datetime
 import io
-import pickle
+import json
 import traceback
 import sys
 from zipfile import ZipFile
 
 from descartes import PolygonPatch
 import matplotlib
-import matplotlib.pyplot as plt
 from pytz import timezone
 import requests
 import shapefile
-from slack_sdk import WebClient
 from slack_sdk.errors import SlackApiError
 
-from .orm import Installation
+from .channels import get_channel_directory
+from .clients import get_client
+from .config import get_config
+from .delivery import get_delivery_queue, wait_for_deliveries
+from .figures import figure_to_png, get_figure_cache
+from .images import store_image
+from .subscribers import get_subscriber_directory
 
 matplotlib.use('Agg')
 
@@ -45,13 +49,14 @@ spc_outlooks = [
 def _plot_spc_outlook(day=1, type="cat"):
     if day > 8 or day < 1:
         raise ValueError("Day must be between 1 and 8")
-    with open(".states/US.pickle", "rb") as f:
-        fig = pickle.load(f)
-    ax = fig.axes[0]
+    with get_figure_cache().figure("US") as fig:
+        return _plot_spc_outlook_on(fig, fig.axes[0], day, type)
 
+
+def _plot_spc_outlook_on(fig, ax, day, type):
     outlook = spc_outlooks[day-1]
     if type == "cat":
-        plt.title(f"Day {day} Categorical Outlook", fontsize=32)
+        ax.set_title(f"Day {day} Categorical Outlook", fontsize=32)
         with ZipFile(io.BytesIO(requests.get(outlook).content)) as z:
             # Grab categorical outlook
             reader = shapefile.Reader(
@@ -81,13 +86,13 @@ def _plot_spc_outlook(day=1, type="cat"):
                             fontsize=24)
     elif type == "wind" or type == "torn" or type == "hail" or (day == 3 and type == "prob"):
         if type == "wind":
-            plt.title(f"Day {day} Wind Outlook", fontsize=32)
+            ax.set_title(f"Day {day} Wind Outlook", fontsize=32)
         elif type == "torn":
-            plt.title(f"Day {day} Tornado Outlook", fontsize=32)
+            ax.set_title(f"Day {day} Tornado Outlook", fontsize=32)
         elif type == "hail":
-            plt.title(f"Day {day} Hail Outlook", fontsize=32)
+            ax.set_title(f"Day {day} Hail Outlook", fontsize=32)
         elif type == "prob":
-            plt.title(f"Day {day} Probability Outlook", fontsize=32)
+            ax.set_title(f"Day {day} Probability Outlook", fontsize=32)
 
         with ZipFile(io.BytesIO(requests.get(outlook).content)) as z:
             # Grab categorical outlook
@@ -128,7 +133,7 @@ def _plot_spc_outlook(day=1, type="cat"):
                                 transform=ax.transAxes,
                                 fontsize=24)
     elif type == "prob":
-        plt.title(f"Day {day} Probability Outlook", fontsize=32)
+        ax.set_title(f"Day {day} Probability Outlook", fontsize=32)
         # This is the same as the other ones, but the file name has a date within it
         with ZipFile(io.BytesIO(requests.get(outlook).content)) as z:
             # Grab the outlooks
@@ -174,13 +179,7 @@ def _plot_spc_outlook(day=1, type="cat"):
         raise ValueError("Invalid outlook type")
 
     ax.legend()
-    buf = io.BytesIO()
-    plt.savefig(buf, format='png', bbox_inches='tight')
-    buf.seek(0)
-    image = buf.getvalue()
-    buf.close()
-    plt.close()
-    return image
+    return figure_to_png(fig)
 
 
 def send_outlook_image(day, type):
@@ -201,16 +200,47 @@ def send_outlook_image(day, type):
         raise ValueError("Invalid outlook type")
 
     try:
-        for installation in Installation.state_index.scan():
-            client = WebClient(token=installation.bot_token)
-            for channel in client.conversations_list()['channels']:
-                if channel['is_member'] and not channel['is_archived'] and not channel['is_im']:
-                    client.files_upload_v2(
-                        channel=channel['id'],
-                        content=image,
-                        title=title,
-                        filename=f"{title}.png",
-                    )
+        image_url = None
+        if get_config().get('slack', 'image_delivery') == 's3':
+            image_url = store_image(image)
+        deliveries = []
+        for installation in get_subscriber_directory().all():
+            client = get_client(installation.team_id, installation.bot_token)
+            channel_ids = get_channel_directory().get_channels(installation.team_id, client)
+            if not channel_ids:
+                continue
+            if image_url:
+                for channel_id in channel_ids:
+                    deliveries.append(get_delivery_queue().submit(
+                        get_delivery_queue().call, installation.team_id, client, 'chat_postMessage',
+                        channel=channel_id,
+                        blocks=json.dumps([{
+                            "type": "image",
+                            "title": {"type": "plain_text", "text": title},
+                            "image_url": image_url,
+                            "alt_text": title,
+                        }]),
+                        text=title,
+                    ))
+                continue
+            if get_config().get('slack', 'upload_mode') == 'shared':
+                deliveries.append(get_delivery_queue().submit(
+                    get_delivery_queue().call, installation.team_id, client, 'upload_and_share',
+                    content=image,
+                    title=title,
+                    filename=f"{title}.png",
+                    channel_ids=channel_ids,
+                ))
+                continue
+            for channel_id in channel_ids:
+                deliveries.append(get_delivery_queue().submit(
+                    get_delivery_queue().call, installation.team_id, client, 'files_upload_v2',
+                    channel=channel_id,
+                    content=image,
+                    title=title,
+                    filename=f"{title}.png",
+                ))
+        wait_for_deliveries(deliveries)
     except SlackApiError as e:
         print(f"Error posting message: {e}")
         traceback.print_exception(*sys.exc_info())
@@ -1,3 +1,4 @@
+from .metrics import log_metrics
 from .spc_common import send_outlook_image
 
 
@@ -8,6 +9,7 @@ def main():
     send_outlook_image(day=1, type="hail")
     send_outlook_image(day=1, type="torn")
     send_outlook_image(day=1, type="wind")
+    log_metrics()
     print("Done")
     return
 
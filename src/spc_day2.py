@@ -1,5 +1,6 @@
 import sys
 
+from .metrics import log_metrics
 from .spc_common import is_cdt_active, send_outlook_image
 
 
@@ -24,6 +25,7 @@ def main():
     send_outlook_image(day=2, type="hail")
     send_outlook_image(day=2, type="torn")
     send_outlook_image(day=2, type="wind")
+    log_metrics()
     print("Done")
     return
 
@@ -1,5 +1,6 @@
 import sys
 
+from .metrics import log_metrics
 from .spc_common import is_cdt_active, send_outlook_image
 
 
@@ -22,6 +23,7 @@ def main():
     print("Running script")
     send_outlook_image(day=3, type="cat")
     send_outlook_image(day=3, type="prob")
+    log_metrics()
     print("Done")
     return
 
@@ -1,5 +1,6 @@
 import sys
 
+from .metrics import log_metrics
 from .spc_common import is_cdt_active, send_outlook_image
 
 
@@ -25,6 +26,7 @@ def main():
     send_outlook_image(day=6, type="prob")
     send_outlook_image(day=7, type="prob")
     send_outlook_image(day=8, type="prob")
+    log_metrics()
     print("Done")
     return
 
@@ -0,0 +1,82 @@
+from collections import namedtuple
+from threading import Lock
+import time
+
+from .config import get_config
+from .orm import Installation
+
+Subscriber = namedtuple('Subscriber', ['team_id', 'bot_token', 'state'])
+
+_subscriber_directory = None
+
+
+def get_subscriber_directory():
+    global _subscriber_directory
+    if _subscriber_directory is None:
+        _subscriber_directory = SubscriberDirectory(get_config().get('slack', 'subscriber_refresh_interval'))
+    return _subscriber_directory
+
+
+class SubscriberDirectory():
+    """
+    Keeps every installation's token and state in memory so alerts, outlooks and
+    slash commands don't read DynamoDB. The table is loaded once, kept up to date
+    by the install and /alert paths and loaded again after refresh_interval
+    seconds in case an update from another process was missed
+    """
+
+    def __init__(self, refresh_interval):
+        self._refresh_interval = refresh_interval
+        self._subscribers = {}
+        self._loaded = 0
+        self._lock = Lock()
+
+    def _ensure_loaded(self):
+        with self._lock:
+            if time.time() - self._loaded < self._refresh_interval:
+                return
+        subscribers = {}
+        for installation in Installation.scan():
+            subscribers[installation.team_id] = Subscriber(
+                installation.team_id, installation.bot_token, installation.state)
+        with self._lock:
+            self._subscribers = subscribers
+            self._loaded = time.time()
+
+    def get(self, team_id):
+        self._ensure_loaded()
+        with self._lock:
+            subscriber = self._subscribers.get(team_id)
+        if subscriber is None:
+            # Installed through another web worker since the last load
+            return self.refresh(team_id)
+        return subscriber
+
+    def get_state(self, state):
+        self._ensure_loaded()
+        with self._lock:
+            return [subscriber for subscriber in self._subscribers.values() if subscriber.state == state]
+
+    def all(self):
+        self._ensure_loaded()
+        with self._lock:
+            return [subscriber for subscriber in self._subscribers.values() if subscriber.state]
+
+    def update(self, team_id, bot_token=None, state=None):
+        with self._lock:
+            subscriber = self._subscribers.get(team_id, Subscriber(team_id, None, None))
+            if bot_token is not None:
+                subscriber = subscriber._replace(bot_token=bot_token)
+            if state is not None:
+                subscriber = subscriber._replace(state=state)
+            self._subscribers[team_id] = subscriber
+            return subscriber
+
+    def refresh(self, team_id):
+        try:
+            installation = Installation.get(team_id)
+        except Installation.DoesNotExist:
+            with self._lock:
+                self._subscribers.pop(team_id, None)
+            return None
+        return self.update(team_id, bot_token=installation.bot_token, state=installation.state)
@@ -0,0 +1,158 @@
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
+import json
+import os
+import sys
+from threading import Lock
+import time
+import traceback
+
+from .config import get_config
+
+import requests
+from shapely.geometry import mapping, shape
+
+_zone_cache = None
+
+
+def get_zone_cache():
+    global _zone_cache
+    if _zone_cache is None:
+        _zone_cache = ZoneGeometryCache(
+            get_config().get('zones', 'cache_dir'),
+            get_config().get('zones', 'max_age'),
+            get_config().get('zones', 'workers'),
+            get_config().get('zones', 'memory_entries'),
+        )
+    return _zone_cache
+
+
+class ZoneGeometryCache():
+    """
+    Caches affected zone geometries on disk and the shapes of the most recently
+    used memory_entries zones in memory, keyed by zone URL. Zone boundaries
+    almost never change, so entries are only revalidated with a conditional
+    GET once they are older than max_age seconds
+    """
+
+    def __init__(self, directory, max_age, workers, memory_entries):
+        self._directory = directory
+        self._max_age = max_age
+        self._workers = workers
+        self._memory_entries = memory_entries
+        # Only the shape and its validators, the GeoJSON stays on disk
+        self._entries = OrderedDict()
+        self._lock = Lock()
+        self._session = requests.Session()
+        if not os.path.isdir(self._directory):
+            os.makedirs(self._directory)
+
+    def _path(self, url):
+        return os.path.join(self._directory, hashlib.sha1(url.encode()).hexdigest() + '.json')
+
+    def _remember(self, url, entry):
+        with self._lock:
+            self._entries[url] = entry
+            self._entries.move_to_end(url)
+            while len(self._entries) > self._memory_entries:
+                self._entries.popitem(last=False)
+
+    def _read(self, url):
+        try:
+            with open(self._path(url), 'r') as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError):
+            return None
+
+    def _load(self, url):
+        with self._lock:
+            if url in self._entries:
+                self._entries.move_to_end(url)
+                return self._entries[url]
+        stored = self._read(url)
+        if stored is None:
+            return None
+        entry = {key: value for key, value in stored.items() if key != 'geometry'}
+        entry['shape'] = shape(stored['geometry'])
+        self._remember(url, entry)
+        return entry
+
+    def _save(self, url, entry, geometry):
+        self._remember(url, entry)
+        # Write to a temporary file first so a crash can't leave a truncated entry behind
+        path = self._path(url)
+        stored = {key: value for key, value in entry.items() if key != 'shape'}
+        stored['geometry'] = geometry
+        with open(path + '.tmp', 'w') as f:
+            json.dump(stored, f)
+        os.replace(path + '.tmp', path)
+
+    def _fetch(self, url, entry):
+        headers = {
+            'Accept': 'application/geo+json',
+            'User-Agent': get_config().get('nws', 'user_agent')
+        }
+        if entry is not None and entry['etag'] is not None:
+            headers['If-None-Match'] = entry['etag']
+        if entry is not None and entry['last_modified'] is not None:
+            headers['If-Modified-Since'] = entry['last_modified']
+        response = self._session.get(url, headers=headers)
+        if response.status_code == 304 and entry is not None:
+            entry['fetched'] = time.time()
+            # The GeoJSON is only kept on disk, rebuilt from the shape if that copy is gone
+            stored = self._read(url)
+            self._save(url, entry, stored['geometry'] if stored is not None else mapping(entry['shape']))
+            return entry
+        if response.status_code != 200:
+            raise ValueError('Failed to get polygon')
+        res = response.json()
+        if 'geometry' not in res or res['geometry'] is None:
+            raise ValueError('Invalid polygon')
+        if ('coordinates' not in res['geometry'] and (res['geometry']['type'] != "Polygon" or res['geometry']['type'] != "MultiPolygon")) \
+                and (res['geometry']['type'] != "GeometryCollection"):
+            print(res)
+            print(url)
+            raise ValueError('Invalid polygon')
+        entry = {
+            'url': url,
+            'fetched': time.time(),
+            'etag': response.headers.get('ETag'),
+            'last_modified': response.headers.get('Last-Modified'),
+            'shape': shape(res['geometry']),
+        }
+        self._save(url, entry, res['geometry'])
+        return entry
+
+    def _is_fresh(self, entry):
+        return entry is not None and time.time() - entry['fetched'] < self._max_age
+
+    def _get(self, url):
+        entry = self._load(url)
+        if self._is_fresh(entry):
+            return entry['shape']
+        try:
+            return self._fetch(url, entry)['shape']
+        except Exception:
+            if entry is None:
+                raise
+            # A stale zone is still far better than no map at all
+            print(f"Failed to revalidate zone {url}, using cached geometry")
+            traceback.print_exception(*sys.exc_info())
+            return entry['shape']
+
+    def get_many(self, urls):
+        # Returns the geometries in the same order as urls, fetching any misses concurrently
+        shapes = {}
+        misses = []
+        for url in dict.fromkeys(urls):
+            entry = self._load(url)
+            if self._is_fresh(entry):
+                shapes[url] = entry['shape']
+            else:
+                misses.append(url)
+        if misses:
+            with ThreadPoolExecutor(max_workers=min(self._workers, len(misses))) as executor:
+                for url, geom in zip(misses, executor.map(self._get, misses)):
+                    shapes[url] = geom
+        return [shapes[url] for url in urls]
@@ -58,4 +58,26 @@ resource "aws_dynamodb_table" "alerts" {
     hash_key        = "state"
     projection_type = "ALL"
   }
+
+  ttl {
+    attribute_name = "expires_at"
+    enabled        = true
+  }
+}
+
+resource "aws_dynamodb_table" "leases" {
+  name                        = "${local.name}-leases"
+  hash_key                    = "state"
+  billing_mode                = "PAY_PER_REQUEST"
+  deletion_protection_enabled = false
+
+  attribute {
+    name = "state"
+    type = "S"
+  }
+
+  ttl {
+    attribute_name = "cleanup_at"
+    enabled        = true
+  }
 }
@@ -37,6 +37,7 @@ data "aws_iam_policy_document" "allow-dynamodb" {
       "${aws_dynamodb_table.alerts.arn}/index/*",
       aws_dynamodb_table.installations.arn,
       "${aws_dynamodb_table.installations.arn}/index/*",
+      aws_dynamodb_table.leases.arn,
     ]
   }
 }